@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+from PDFScraper.dataStructure import Document
+
+logger = logging.getLogger("PDFScraper")
+
+
+# Computes sha256 of the file content in chunks, so big files are not loaded into memory
+def file_hash(path: str, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# Persistent on-disk cache of extracted Documents.
+# Entries are keyed by the content of the file and the settings used for extraction,
+# so renamed or moved files still hit the cache and changed settings never return stale results.
+class ExtractionCache:
+    def __init__(self, directory: str, max_size=None, max_age=None):
+        self.directory = directory
+        # maximum size of the cache in bytes, None for unlimited
+        self.max_size = max_size
+        # maximum age of an entry in seconds, None for unlimited
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path: str, settings: dict):
+        sha = hashlib.sha256(file_hash(path).encode())
+        sha.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+
+    def _entry_path(self, key: str):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def _expired(self, mtime: float):
+        return self.max_age is not None and time.time() - mtime > self.max_age
+
+    def get(self, key: str):
+        entry_path = self._entry_path(key)
+        try:
+            if self._expired(os.path.getmtime(entry_path)):
+                os.remove(entry_path)
+                return None
+            with open(entry_path, 'rb') as f:
+                document = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # corrupted or incompatible entry
+            logger.warning("Removing unreadable cache entry " + entry_path + ": " + str(e))
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            return None
+        if not isinstance(document, Document):
+            return None
+        # mark entry as recently used, eviction removes least recently used entries first
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return document
+
+    def put(self, key: str, document: Document):
+        # write to a temporary file first, so concurrent workers never read partially written entries
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(document, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._entry_path(key))
+        except Exception as e:
+            logger.warning("Could not cache document " + document.path + ": " + str(e))
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    # Removes entries older than max_age and then least recently used entries until the cache fits into max_size
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not entry.name.endswith(".pickle"):
+                continue
+            stat = entry.stat()
+            if self._expired(stat.st_mtime):
+                os.remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        if self.max_size is None:
+            return
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
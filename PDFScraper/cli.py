@@ -1,17 +1,35 @@
 import argparse
+import hashlib
+import importlib.util
+import itertools
 import logging
 import multiprocessing
 import os
+import re
 import shutil
 import signal
 import sys
 import tempfile
+import time
+from multiprocessing.util import Finalize
 
-import psutil
+from pytesseract import TesseractNotFoundError, TesseractError
 
-from PDFScraper.core import get_filename, pdf_to_image, convert_to_pdf, get_pdf_object, extract_page_layouts, \
-    extract_tables, parse_layouts, extract_table_of_contents, extract_info, find_pdfs_in_path
-from PDFScraper.outputGenerator import generate_html
+from PDFScraper import version
+from PDFScraper.cache import ExtractionCache, file_hash
+from PDFScraper.core import get_filename, iter_page_images, ocr_document, iter_page_layouts, extract_tables, \
+    parse_elements, parse_page_ranges, extract_table_of_contents, extract_info, find_pdfs_in_path, LAYOUT_OPTIONS, \
+    TABLE_OPTIONS, OCR_OPTIONS, render_page, preprocess_image, ocr_image, merge_pdf_pages, record_timing, \
+    tsv_paragraphs, page_needs_ocr, TableIndex, page_may_contain_table, parse_table_options, search_document, \
+    detect_language, is_document_path
+from PDFScraper.dataStructure import Document
+from PDFScraper.outputGenerator import generate_report, open_report
+from PDFScraper.journal import Journal, file_state
+from PDFScraper.ocrEngine import close_engines
+from PDFScraper.scheduler import Scheduler, stage, stopped
+from PDFScraper.searchIndex import SearchIndex
+from PDFScraper.watcher import Watcher
+from PDFScraper.session import DocumentSession
 
 # Define logger level helper
 logger_switcher = {
@@ -47,10 +65,42 @@ def search_mode_helper(v):
         raise argparse.ArgumentTypeError('"and" or "or" value expected')
 
 
+# page ranges input helper
+def page_ranges_helper(v):
+    try:
+        parse_page_ranges(v, 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Page ranges like "1-3,5,10-" expected')
+    return v
+
+
+# stage limit input helper
+def workers_helper(v):
+    if v == 'auto':
+        return v
+    try:
+        if int(v) > 0:
+            return int(v)
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError('Positive number or "auto" expected')
+
+
 # Parse arguments from command line
 argumentParser = argparse.ArgumentParser()
+# search -> extract and search, index -> extract into index, query -> search the index
+argumentParser.add_argument('command', nargs='?', choices=['search', 'index', 'query'],
+                            help='search extracts and searches documents, index stores extracted documents in the '
+                                 'index, query searches the index (default: search)', default='search')
 argumentParser.add_argument('--path', help='path to pdf folder or file', default=".")
 argumentParser.add_argument('--out', help='path to output file location', default=".")
+argumentParser.add_argument('--include', action='append', help='glob pattern of files to process, can be given '
+                                                                'multiple times (default: all PDFs and images)',
+                            default=[])
+argumentParser.add_argument('--exclude', action='append', help='glob pattern of files and directories to skip, can be '
+                                                                'given multiple times', default=[])
+argumentParser.add_argument('--sniff', type=str2bool, help='should file types be detected from file content instead '
+                                                           'of extensions', default=False)
 argumentParser.add_argument('--log_level', choices=['critical', 'error', 'warning', 'info', 'debug'], help='logger '
                                                                                                            'level to '
                                                                                                            'use ('
@@ -59,119 +109,671 @@ argumentParser.add_argument('--log_level', choices=['critical', 'error', 'warnin
                             default='info')
 argumentParser.add_argument('--search', help='word to search for', default="default")
 argumentParser.add_argument('--tessdata', help='location of tesseract data files', default="/usr/share/tessdata")
+argumentParser.add_argument('--pages', type=page_ranges_helper, help='pages to extract, for example "1-3,5,10-" '
+                                                                    '(default: all pages)', default=None)
 argumentParser.add_argument('--tables', type=str2bool, help='should tables be extracted and searched', default=True)
+argumentParser.add_argument('--table_prefilter', type=str2bool, help='should tables be extracted only from pages '
+                                                                       'whose layout looks like a table',
+                            default=True)
 # True -> and mode, False -> or mode
 argumentParser.add_argument('--search_mode', type=search_mode_helper, help='And or Or search, when multiple '
                                                                            'search words are provided',
                             default=True)
+argumentParser.add_argument('--report_page_size', type=int, help='number of matching paragraphs and tables after '
+                                                                  'which the summary continues on a new page, 0 '
+                                                                  'writes a single page (default: 0)', default=0)
+argumentParser.add_argument('--format', choices=['html', 'jsonl', 'parquet'],
+                            help='format of search results, html writes summary.html, jsonl and parquet export '
+                                 'paragraphs, table cells, document info and search hits (default: html)',
+                            default='html')
 argumentParser.add_argument('--multiprocessing', type=str2bool, help='should multiprocessing be enabled', default=True)
+argumentParser.add_argument('--parse_workers', type=workers_helper, help='number of documents parsed in parallel '
+                                                                         'when multiprocessing is enabled (default: '
+                                                                         'auto)', default='auto')
+argumentParser.add_argument('--table_workers', type=workers_helper, help='number of documents whose tables are '
+                                                                         'extracted in parallel (default: auto)',
+                            default='auto')
+argumentParser.add_argument('--render_workers', type=workers_helper, help='number of pages rendered and preprocessed '
+                                                                          'in parallel for OCR (default: auto)',
+                            default='auto')
+argumentParser.add_argument('--ocr_workers', type=workers_helper, help='number of pages OCRed in parallel when '
+                                                                       'multiprocessing is enabled (default: auto)',
+                            default='auto')
+argumentParser.add_argument('--output_workers', type=workers_helper, help='number of threads used to search '
+                                                                          'documents (default: auto)', default='auto')
+argumentParser.add_argument('--pages_in_flight', type=int, help='maximum number of rendered pages kept in memory per '
+                                                                'document during OCR', default=4)
+argumentParser.add_argument('--languages', help='Tesseract languages used for OCR, for example "eng+slv" '
+                                                 '(default: eng)', default='eng')
+argumentParser.add_argument('--detect_language', type=str2bool, help='should one of the languages be detected for '
+                                                                     'every document before OCR', default=False)
+argumentParser.add_argument('--ocr_backend', choices=['auto', 'tesserocr', 'pytesseract'],
+                            help='how Tesseract is run, tesserocr keeps language models loaded between pages, '
+                                 'pytesseract starts tesseract for every page, auto uses tesserocr when it is '
+                                 'installed (default: auto)', default='auto')
+argumentParser.add_argument('--deskew', choices=['fast', 'accurate', 'none'], help='method used to straighten pages '
+                                                                                  'before OCR (default: fast)',
+                            default='fast')
+argumentParser.add_argument('--preprocess', choices=['none', 'fast', 'full', 'auto'], help='denoising applied to '
+                                                                                          'pages before OCR, auto '
+                                                                                          'picks it based on noise '
+                                                                                          'in the page (default: '
+                                                                                          'auto)', default='auto')
+argumentParser.add_argument('--ocr_pdf', type=str2bool, help='should searchable PDFs of OCRed pages be saved to the '
+                                                             'output directory, tables are only extracted from '
+                                                             'OCRed pages when they are saved', default=False)
+argumentParser.add_argument('--index', help='path to the search index file (default: OUT/PDFScraper.sqlite)',
+                            default=None)
+argumentParser.add_argument('--cache', help='directory of the extraction cache (default: disabled)', default=None)
+argumentParser.add_argument('--cache_max_size', type=float, help='maximum size of the extraction cache in MB',
+                            default=1024)
+argumentParser.add_argument('--cache_max_age', type=float, help='maximum age of extraction cache entries in days',
+                            default=30)
+argumentParser.add_argument('--journal', help='path to the journal of finished documents, which is used to resume '
+                                               'interrupted runs (default: OUT/PDFScraper.journal)', default=None)
+argumentParser.add_argument('--resume', type=str2bool, help='should documents finished by the interrupted run be '
+                                                            'skipped', default=False)
+argumentParser.add_argument('--incremental', type=str2bool, help='should the index command only extract new and '
+                                                                 'changed documents and remove deleted ones',
+                            default=False)
+argumentParser.add_argument('--watch', type=str2bool, help='should the index command keep watching the path and '
+                                                           'index documents as they change', default=False)
+argumentParser.add_argument('--watch_interval', type=float, help='seconds between checks of the path, when inotify '
+                                                                 'is not available', default=60)
 args = vars(argumentParser.parse_args())
+if (args["incremental"] or args["watch"]) and args["command"] != 'index':
+    argumentParser.error('--incremental and --watch can only be used with the index command')
+if args["format"] == 'parquet' and importlib.util.find_spec("pyarrow") is None:
+    argumentParser.error('parquet format requires pyarrow, install it with pip install PDFScraper[parquet]')
 output_path = args["out"]
 log_level = logger_switcher.get(args["log_level"])
 search_word = args["search"]
+search_words = search_word.split(",")
 tessdata_location = args["tessdata"]
 tables_extract = args["tables"]
+table_prefilter = args["table_prefilter"]
+table_flavor = parse_table_options().get("flavor", "lattice")
+page_ranges = args["pages"]
 search_mode = args["search_mode"]
+report_page_size = max(0, args["report_page_size"])
+report_format = args["format"]
+command = args["command"]
+# with multiprocessing, pages of all documents are OCRed in a shared pool after regular extraction
+page_ocr = args["multiprocessing"]
+# concurrency limits of pipeline stages, auto limits depend on number of cores and available memory
+scheduler = Scheduler({
+    "parse": args["parse_workers"],
+    "tables": args["table_workers"],
+    "render": args["render_workers"],
+    "ocr": args["ocr_workers"],
+    "output": args["output_workers"]
+})
+pages_in_flight = max(1, args["pages_in_flight"])
+ocr_backend = args["ocr_backend"]
+ocr_languages = args["languages"]
+detect_ocr_language = args["detect_language"]
+deskew_mode = args["deskew"]
+preprocess_profile = args["preprocess"]
+# text of OCRed pages is read from Tesseract's word boxes, searchable PDFs are only built when they are kept
+save_ocr_pdf = args["ocr_pdf"]
+# number of pages, whose layouts are kept until tables are extracted from them
+TABLE_BATCH_PAGES = 8
+# total time spent in every OCR stage, logged at the end
+ocr_timings = {}
+output_directory = output_path if os.path.isdir(output_path) else os.path.dirname(os.path.abspath(output_path))
+index_path = args["index"]
+if index_path is None:
+    index_path = os.path.join(output_directory, "PDFScraper.sqlite")
+journal_path = args["journal"]
+if journal_path is None:
+    journal_path = os.path.join(output_directory, "PDFScraper.journal")
+resume = args["resume"]
+# watching indexes changes incrementally
+watch = args["watch"]
+incremental = args["incremental"] or watch
+watch_interval = args["watch_interval"]
+# path -> (size, mtime, sha256) of documents, which are recorded in the index manifest once they are indexed
+manifest_updates = {}
+extraction_cache = None
+if args["cache"] is not None:
+    extraction_cache = ExtractionCache(os.path.abspath(args["cache"]),
+                                       max_size=int(args["cache_max_size"] * 1024 * 1024),
+                                       max_age=args["cache_max_age"] * 24 * 60 * 60)
+# settings that influence extraction results, cached documents are only reused if they match
+extraction_settings = {
+    "version": version(),
+    "tables": tables_extract,
+    "table_prefilter": table_prefilter,
+    "pages": page_ranges,
+    "tessdata": tessdata_location,
+    "languages": ocr_languages,
+    "detect_language": detect_ocr_language,
+    "ocr_pdf": save_ocr_pdf,
+    "ocr_backend": ocr_backend,
+    "deskew": deskew_mode,
+    "preprocess": preprocess_profile,
+    "layout": LAYOUT_OPTIONS,
+    "table": TABLE_OPTIONS,
+    "ocr": OCR_OPTIONS
+}
 
 # Set up logger
 logger = logging.getLogger("PDFScraper")
 logger.setLevel(log_level)
 
 
+# settings that influence results stored in the journal, finished documents are only skipped if they match
+journal_settings = dict(extraction_settings, command=command, search=search_words, search_mode=search_mode,
+                        format=report_format)
+
+
 # Define signal handlers
+# First Ctrl+C lets workers finish documents in progress, second one exits immediately
 def signal_handler(sign, frame):
     logger.info("Ctrl+C pressed")
-    logger.info("Stopping")
-    sys.exit(0)
+    if scheduler.stopped:
+        logger.info("Stopping")
+        sys.exit(1)
+    logger.info("Finishing documents in progress. Press Ctrl+C again to stop immediately")
+    scheduler.stop()
 
 
 # Start signal handlers
 signal.signal(signal.SIGINT, signal_handler)
 
 
+def cache_key(doc):
+    try:
+        return extraction_cache.key(doc.path, extraction_settings)
+    except OSError as e:
+        logger.warning("Could not read " + doc.path + " for caching: " + str(e))
+        return None
+
+
+def cache_doc(doc):
+    if extraction_cache is not None:
+        key = cache_key(doc)
+        if key is not None:
+            extraction_cache.put(key, doc)
+
+
 def process_doc(doc):
+    key = None
+    if extraction_cache is not None:
+        key = cache_key(doc)
+        cached = extraction_cache.get(key) if key is not None else None
+        if cached is not None:
+            logger.debug("Using cached extraction results for " + doc.path)
+            # same content might be stored under a different path
+            cached.path = doc.path
+            cached.ocr_path = doc.path
+            get_filename(cached)
+            return cached
+    extract_doc(doc).compact()
+    # documents waiting for OCR are cached once OCR is done
+    if key is not None and len(doc.ocr_pages) == 0:
+        extraction_cache.put(key, doc)
+    return doc
+
+
+# Extracts tables from pages of the layouts and parses the layouts, leaving out text of the tables.
+# Layouts are removed from the list afterwards, so they can be freed
+def parse_table_pages(doc, table_layouts):
+    if len(table_layouts) == 0:
+        return
+    tables = doc.tables
+    with stage("tables"):
+        extract_tables(doc, pages=[page for page, _ in table_layouts])
+    # only tables of these pages can overlap their elements
+    table_index = TableIndex(doc.tables)
+    doc.tables = tables + doc.tables
+    for page, page_layout in table_layouts:
+        parse_elements(doc, page_layout, page, table_index)
+    table_layouts.clear()
+
+
+def extract_doc(doc):
 
-    extract_info(doc)
     get_filename(doc)
     if doc.is_pdf:
-        pdf_object = get_pdf_object(doc)
-        if doc.extractable:
-
-            logger.debug('Document information:' + '\n' + doc.document_info_to_string())
-            extract_table_of_contents(doc, pdf_object)
-            logger.debug('Table of contents: \n' + doc.table_of_contents_to_string())
-            page_layouts = extract_page_layouts(pdf_object)
-            # table extraction is possible only for text based PDFs
-            if tables_extract:
-                extract_tables(doc)
-            parse_layouts(doc, page_layouts)
-            if len(doc.paragraphs) == 0:
-                logger.info("Regular text extraction is not possible. Trying to extract text using OCR")
-                pdf_to_image(doc)
-                convert_to_pdf(doc, tessdata_location)
-                pdf_object = get_pdf_object(doc)
-                page_layouts = extract_page_layouts(pdf_object)
-                if tables_extract:
-                    extract_tables(doc)
-                parse_layouts(doc, page_layouts)
+        ocr_pages = []
+        with DocumentSession(doc.path) as session:
+            extract_info(doc, session)
+            doc.extractable = session.extractable
+            if doc.extractable:
 
-        else:
-            logger.warning("Skipping parsing. Document is not exable.")
+                logger.debug('Document information:' + '\n' + doc.document_info_to_string())
+                extract_table_of_contents(doc, session.pdf_object)
+                logger.debug('Table of contents: \n' + doc.table_of_contents_to_string())
+                pages = None if page_ranges is None else parse_page_ranges(page_ranges, doc.num_pages)
+                # table extraction is possible only for text based PDFs
+                if tables_extract and not table_prefilter:
+                    with stage("tables"):
+                        extract_tables(doc, pages=pages)
+                table_index = TableIndex(doc.tables)
+                # layouts are parsed one page at a time, pages without text layer are OCRed afterwards.
+                # With table prefilter, layouts of pages that look like they contain tables are kept until tables
+                # are extracted from a batch of those pages
+                parsed_pages = []
+                table_layouts = []
+                table_pages = 0
+                for page, page_layout in iter_page_layouts(session.pdf_object, pages=pages):
+                    parsed_pages.append(page)
+                    if page_needs_ocr(page_layout):
+                        ocr_pages.append(page)
+                    elif tables_extract and table_prefilter and page_may_contain_table(page_layout, table_flavor):
+                        table_layouts.append((page, page_layout))
+                        table_pages += 1
+                        if len(table_layouts) >= TABLE_BATCH_PAGES:
+                            parse_table_pages(doc, table_layouts)
+                    else:
+                        parse_elements(doc, page_layout, page, table_index)
+                if tables_extract and table_prefilter:
+                    parse_table_pages(doc, table_layouts)
+                    logger.debug(str(table_pages) + " of " + str(len(parsed_pages)) + " pages may contain tables")
+                    doc.sort_paragraphs_by_page()
+                if len(ocr_pages) == 0 and len(doc.paragraphs) == 0:
+                    ocr_pages = parsed_pages
+
+            else:
+                logger.warning("Skipping parsing. Document is not exable.")
+        if len(ocr_pages) > 0:
+            ocr_doc(doc, ocr_pages)
 
     else:
-        logger.info("Regular text extraction is not possible. Trying to extract text using OCR")
-        pdf_to_image(doc)
-        convert_to_pdf(doc, tessdata_location)
-        pdf_object = get_pdf_object(doc)
-        page_layouts = extract_page_layouts(pdf_object)
-        if tables_extract:
-            extract_tables(doc)
-        parse_layouts(doc, page_layouts)
+        extract_info(doc)
+        ocr_doc(doc, [1])
     logger.debug('Paragraphs: \n' + '\n'.join(doc.paragraphs))
     return doc
 
 
-def cli():
-    path = os.path.abspath(args["path"])
-    logger.info('Finding PDFs in ' + path)
-    # Read PDFs from path
+# With page-level OCR the pages are only recorded, pages of all documents are OCRed together afterwards
+def ocr_doc(doc, pages):
+    logger.info("Regular text extraction is not possible for " + str(len(pages)) + " pages. "
+                "Trying to extract text using OCR")
+    doc.ocr_pages = pages
+    doc.ocr_language = ocr_languages
+    if detect_ocr_language:
+        with stage("ocr"):
+            doc.ocr_language = detect_language(doc, tessdata_location, ocr_languages, ocr_backend)
+        logger.debug("Using language " + doc.ocr_language + " for OCR of " + doc.path)
+    if page_ocr:
+        return
+    page_paragraphs = ocr_document(doc, tessdata_location,
+                                   images=iter_page_images(doc, window=pages_in_flight, pages=pages),
+                                   deskew_mode=deskew_mode, profile=preprocess_profile, timings=ocr_timings,
+                                   backend=ocr_backend, pdf_path=ocr_pdf_path(doc) if save_ocr_pdf else None)
+    parse_ocr_doc(doc, page_paragraphs)
+
+
+# Searchable PDF of OCRed pages is saved next to the output. Hash of the document path keeps PDFs of documents with
+# the same filename in different directories apart
+def ocr_pdf_path(doc):
+    digest = hashlib.sha256(os.path.abspath(doc.path).encode()).hexdigest()[:8]
+    return os.path.join(output_directory, doc.filename + "_" + digest + "_ocr.pdf")
+
+
+# Add text and tables of OCRed pages to the document, in order of pages.
+# page_paragraphs contains paragraphs of every OCRed page, tables are extracted when searchable PDF was saved
+def parse_ocr_doc(doc, page_paragraphs):
+    # searchable PDF is not saved when some page could not be read
+    if tables_extract and save_ocr_pdf and doc.ocr_path != doc.path:
+        text_tables = [table for table in doc.tables if int(table.page) not in doc.ocr_pages]
+        with stage("tables"):
+            extract_tables(doc)
+        # pages of OCR document are only the OCRed pages
+        for table in doc.tables:
+            table.page = str(doc.ocr_pages[int(table.page) - 1])
+        doc.tables = text_tables + doc.tables
+    table_index = TableIndex(doc.tables)
+    for paragraphs, page in zip(page_paragraphs, doc.ocr_pages):
+        for text, bbox in paragraphs:
+            # skip if paragraph is inside detected table
+            if len(table_index) > 0 and table_index.overlaps(page, bbox):
+                continue
+            doc.add_paragraph(text, page, bbox)
+    doc.sort_paragraphs_by_page()
+    doc.ocr_pages = []
+    return doc
+
+
+# Limit threads of every Tesseract process, so that OCR workers together use each core once.
+# Tesseract engines of the worker are released when it exits after the pool is closed
+def init_ocr_worker(threads):
+    os.environ["OMP_THREAD_LIMIT"] = str(threads)
+    Finalize(None, close_engines, exitpriority=10)
+
+
+# Returned by OCR workers instead of paragraphs when tesseract is not installed. pytesseract's TesseractNotFoundError
+# can not be unpickled, so raising it in a worker would stop the pool from returning results
+TESSERACT_NOT_FOUND = "tesseract not found"
+
+
+# Returns paragraphs of the page, single page PDF if it is saved and time spent in every stage
+def ocr_page_task(task):
+    if stopped():
+        return (None, None), {}
+    doc, page, language = task
+    timings = {}
+    # rendered page and its copies take most of the memory, so rendering and preprocessing are limited together
+    with stage("render"):
+        start = time.perf_counter()
+        img = render_page(doc, page)
+        record_timing(timings, "render", start)
+        if img is None:
+            logger.warning("Could not read image " + doc.path + ", skipping it")
+            return ([], None), timings
+        img = preprocess_image(img, deskew_mode, preprocess_profile, timings)
+    start = time.perf_counter()
     try:
-        docs = find_pdfs_in_path(path)
+        tsv, pdf_page = ocr_image(img, language, tessdata_location, backend=ocr_backend, pdf=save_ocr_pdf)
+    except TesseractNotFoundError:
+        return (TESSERACT_NOT_FOUND, None), timings
+    paragraphs = tsv_paragraphs(tsv)
+    record_timing(timings, "ocr", start)
+    return (paragraphs, pdf_page), timings
+
+
+# Yields next count pages from OCR results and adds their timings to the total
+def collect_pages(results, count):
+    for page, timings in itertools.islice(results, count):
+        for name, seconds in timings.items():
+            ocr_timings[name] = ocr_timings.get(name, 0.0) + seconds
+        yield page
+
+
+def log_timings():
+    if len(ocr_timings) > 0:
+        logger.info('Time spent in OCR stages: ' + ', '.join(
+            name + ' ' + '{:.1f}'.format(seconds) + 's' for name, seconds in ocr_timings.items()))
+
+
+# Returns what is sent to the parent process for the document. Documents waiting for OCR and indexed documents are
+# returned whole, otherwise search results are returned, together with the document when its content is exported
+def document_result(doc, workers=1):
+    doc.compact()
+    if command == 'index' or len(doc.ocr_pages) > 0:
+        return doc
+    with stage("output"):
+        result = search_document(doc, search_words, search_mode, 80, workers)
+    if report_format != 'html':
+        result.document = doc
+    return result
+
+
+# Result of a document, which could not be extracted
+class FailedDocument:
+    def __init__(self, path: str):
+        self.path = path
+
+
+# Errors of a single document, like a truncated PDF, are logged and the document is skipped, so they do not stop the
+# whole run
+def extract_result(doc, workers=1):
+    try:
+        return document_result(process_doc(doc), workers)
     except Exception as e:
-        logger.error(e)
-        sys.exit(1)
-    logger.info('Found ' + str(len(docs)) + ' PDFs')
+        logger.error("Could not extract " + doc.path + ", skipping it: " + repr(e))
+        return FailedDocument(doc.path)
+
+
+def extract_task(doc):
+    if stopped():
+        return None
+    return extract_result(doc)
+
 
-    logger.info('Parsing ' + str(len(docs)) + ' documents')
-    # Extract information about PDFs
-    progress_counter = 1
+# Documents are parsed even if the run is interrupted, so their OCRed pages are journaled and not OCRed again
+def parse_ocr_task(task):
+    doc, page_paragraphs = task
+    parse_ocr_doc(doc, page_paragraphs).compact()
+    cache_doc(doc)
+    return document_result(doc)
 
-    # Multiprocessing -- Improves speed of processing multiple documents significantly
-    # !! BAD PERFORMANCE OF OCR WITH MULTIPLE FILES
-    if args["multiprocessing"]:
-        with multiprocessing.Pool() as p:
-           docs = p.map(process_doc, docs)
 
+# OCR pages of all marked documents in one bounded pool, so scanned documents are not OCRed one page at a time.
+# Documents are parsed as soon as all their pages are OCRed and their results are yielded as soon as they are parsed.
+# When the run is interrupted, documents whose pages were already OCRed are still parsed and yielded
+def ocr_docs(ocr_documents):
+    if len(ocr_documents) == 0 or scheduler.stopped:
+        return
+    # workers only need the location of the document
+    tasks = [(Document(doc.path, doc.is_pdf), page - 1, doc.ocr_language) for doc in ocr_documents
+             for page in doc.ocr_pages]
+    logger.info('Running OCR on ' + str(len(tasks)) + ' pages of ' + str(len(ocr_documents)) + ' documents')
+    threads = max(1, multiprocessing.cpu_count() // scheduler.limits["ocr"])
+    progress_counter = 0
+    # results of documents, which are being parsed
+    pending = []
+    with scheduler.pool("parse") as parse_pool:
+        # every worker renders and OCRs a single page, so at most one page per OCR worker is in memory at once.
+        # Searchable PDFs are merged as soon as all pages of a document are done
+        try:
+            with scheduler.pool("ocr", initializer=init_ocr_worker, initargs=(threads,)) as p:
+                results = p.imap(ocr_page_task, tasks)
+                for doc in ocr_documents:
+                    pages = list(collect_pages(results, len(doc.ocr_pages)))
+                    if any(paragraphs == TESSERACT_NOT_FOUND for paragraphs, _ in pages):
+                        raise TesseractNotFoundError()
+                    # pages skipped after the run was interrupted
+                    if any(paragraphs is None for paragraphs, _ in pages):
+                        break
+                    if save_ocr_pdf and all(pdf_page is not None for _, pdf_page in pages):
+                        merge_pdf_pages(doc, [pdf_page for _, pdf_page in pages], ocr_pdf_path(doc))
+                    pending.append(parse_pool.apply_async(parse_ocr_task,
+                                                          ((doc, [paragraphs for paragraphs, _ in pages]),)))
+                    for result in [result for result in pending if result.ready()]:
+                        pending.remove(result)
+                        progress_counter += 1
+                        yield parsed_ocr_result(result, progress_counter, len(ocr_documents))
+                    if scheduler.stopped:
+                        break
+                # wait for pages in progress
+                p.close()
+                p.join()
+        except TesseractNotFoundError:
+            logger.error("Tesseract is not installed. Exiting")
+            sys.exit(1)
+        except TesseractError as e:
+            logger.error(e)
+            sys.exit(1)
+        for result in pending:
+            progress_counter += 1
+            yield parsed_ocr_result(result, progress_counter, len(ocr_documents))
+
+
+def parsed_ocr_result(result, counter, total):
+    logger.info('Parsed OCR results of ' + str(counter) + ' out of ' + str(total) + ' documents')
+    return result.get()
+
+
+def log_progress(counter, total):
+    if total is None:
+        logger.info('Parsed ' + str(counter) + ' documents')
     else:
+        logger.info('Parsed ' + str(counter) + ' out of ' + str(total) + ' documents')
+
+
+# Stores result of a document in the index or writes it to the summary and records the document as finished.
+# Documents, which could not be extracted, are recorded in the index, so incremental indexing skips them until they
+# change
+def write_result(output, result, journal=None):
+    if isinstance(result, FailedDocument):
+        if command == 'index' and result.path in manifest_updates:
+            size, mtime, _ = manifest_updates.pop(result.path)
+            output.set_failed(result.path, size, mtime)
+        return
+    if command == 'index':
+        output.add_document(result)
+        if result.path in manifest_updates:
+            output.set_file(result.path, *manifest_updates.pop(result.path))
+    else:
+        output.write(result)
+    if journal is not None:
+        journal.add(result.path, result)
+
+
+def query():
+    logger.info('Searching index ' + index_path)
+    if not os.path.isfile(index_path):
+        logger.error('Index ' + index_path + ' does not exist. Create it with the index command')
+        sys.exit(1)
+    with SearchIndex(index_path) as index:
+        logger.info('Searching ' + str(len(index)) + ' documents')
+        generate_report(output_path, index.documents(), search_word, search_mode, workers=scheduler.limits["output"],
+                        page_size=report_page_size, report_format=report_format)
+    logger.info('Stopping')
+    sys.exit(0)
+
+
+# Returns documents, which are new or changed since they were indexed, and removes deleted documents from the index.
+# Files with the same size and modification time are not read, files which were only touched are not parsed again
+def changed_docs(docs, path):
+    changed = []
+    with SearchIndex(index_path) as index:
+        files = index.files()
+        failed = index.failed_files()
+        found = set()
         for doc in docs:
-            process_doc(doc)
-            logger.info('Parsed ' + str(progress_counter) + ' out of ' + str(len(docs)) + ' documents')
-            progress_counter += 1
+            found.add(doc.path)
+            try:
+                size, mtime = file_state(doc.path)
+                if doc.path in files and files[doc.path][:2] == (size, mtime):
+                    continue
+                # documents, which could not be extracted, are tried again once they change
+                if failed.get(doc.path) == (size, mtime):
+                    continue
+                sha256 = file_hash(doc.path)
+            except OSError as e:
+                logger.warning("Could not read " + doc.path + ": " + str(e))
+                continue
+            if doc.path in files and files[doc.path][2] == sha256:
+                index.set_file(doc.path, size, mtime, sha256)
+                continue
+            manifest_updates[doc.path] = (size, mtime, sha256)
+            changed.append(doc)
+        # only documents under the indexed path are removed, so index can contain multiple folders
+        def is_removed(indexed):
+            return indexed not in found and (indexed == path or indexed.startswith(os.path.join(path, '')))
+        removed = [indexed for indexed in index.paths() if is_removed(indexed)]
+        for indexed in removed:
+            index.remove_document(indexed)
+        for failed_path in filter(is_removed, failed):
+            index.remove_failed(failed_path)
+    logger.info('Found ' + str(len(found)) + ' PDFs')
+    logger.info(str(len(changed)) + ' documents are new or changed, ' + str(len(removed)) +
+                ' deleted documents were removed from the index')
+    return changed
+
+
+# Returns True if the file is written by the program, like the index and its SQLite journals, the journal of finished
+# documents and cache entries, so watching does not react to its own output
+def is_output_file(file_path: str):
+    file_path = os.path.abspath(file_path)
+    if file_path.startswith(os.path.abspath(index_path)) or file_path == os.path.abspath(journal_path):
+        return True
+    # searchable PDFs saved by ocr_pdf_path
+    if os.path.dirname(file_path) == os.path.abspath(output_directory) and \
+            re.fullmatch(r".+_[0-9a-f]{8}_ocr\.pdf", os.path.basename(file_path)):
+        return True
+    return args["cache"] is not None and file_path.startswith(os.path.join(os.path.abspath(args["cache"]), ""))
+
+
+def cli():
+    if command == 'query':
+        query()
+    path = os.path.abspath(args["path"])
+    watcher = None
+    if watch:
+        # only changes of files, which would be found in path, start a new pass
+        watcher = Watcher(path, watch_interval, lambda file_path: not is_output_file(file_path) and is_document_path(
+            file_path, path, args["include"], args["exclude"], args["sniff"]))
+    while True:
+        logger.info('Finding PDFs in ' + path)
+        # Read PDFs from path
+        try:
+            docs = find_pdfs_in_path(path, args["include"], args["exclude"], args["sniff"])
+            docs = (doc for doc in docs if not is_output_file(doc.path))
+        except Exception as e:
+            logger.error(e)
+            sys.exit(1)
+        # documents are parsed while the rest of the path is walked, unless changes have to be found first
+        if incremental:
+            docs = changed_docs(docs, path)
+        process_docs(docs)
+        # cache is trimmed after every pass, so it does not grow while watching
+        if extraction_cache is not None:
+            extraction_cache.evict()
+        if watcher is None:
+            break
+        logger.info('Waiting for changes in ' + path)
+        if not watcher.wait(lambda: scheduler.stopped):
+            watcher.close()
+            break
     logger.info('Done parsing PDFs')
-    logger.info('Generating summary')
-    generate_html(output_path, docs, search_word, search_mode)
+    log_timings()
+    # engines of serial OCR and language detection
+    close_engines()
     # clean up temporary directory
     logger.info('Stopping')
     shutil.rmtree(tempfile.gettempdir() + "/PDFScraper", ignore_errors=True)
-    # close all files that were left open
-    try:
-        for fd in psutil.Process().open_files():
-            open(fd.fd).close()
-    except Exception as e:
-        logger.error(e)
 
     sys.exit(0)
 
 
+# Extracts documents and writes their results to the index or the summary
+def process_docs(docs):
+    if command == 'index':
+        logger.info('Writing documents to index ' + index_path)
+        output = SearchIndex(index_path)
+    else:
+        output = open_report(output_path, report_format, report_page_size)
+    journal = Journal(journal_path, journal_settings, resume)
+    with output:
+        # results of documents finished by the interrupted run are written again, their documents are skipped
+        if len(journal) > 0:
+            logger.info('Skipping ' + str(len(journal)) + ' documents finished by the previous run')
+            for result in journal.results():
+                write_result(output, result)
+            docs = (doc for doc in docs if not journal.is_done(doc.path))
+        # number of documents is not known while the path is still walked
+        total = len(docs) if isinstance(docs, list) else None
+        logger.info('Parsing ' + (str(total) + ' documents' if total is not None else 'documents as they are found'))
+        # Multiprocessing -- Improves speed of processing multiple documents significantly
+        # Results are written as soon as documents are done, documents which need OCR are OCRed page by page afterwards
+        if args["multiprocessing"]:
+            logger.debug('Stage limits: ' + str(scheduler))
+            ocr_documents = []
+            progress_counter = 0
+            with scheduler.pool("parse") as p:
+                for result in p.imap_unordered(extract_task, docs):
+                    # documents are skipped after the run is interrupted
+                    if result is None:
+                        continue
+                    progress_counter += 1
+                    if isinstance(result, Document) and len(result.ocr_pages) > 0:
+                        ocr_documents.append(result)
+                    else:
+                        write_result(output, result, journal)
+                    log_progress(progress_counter, total)
+            for result in ocr_docs(ocr_documents):
+                write_result(output, result, journal)
+
+        else:
+            for progress_counter, doc in enumerate(docs, 1):
+                if scheduler.stopped:
+                    break
+                write_result(output, extract_result(doc, scheduler.limits["output"]), journal)
+                log_progress(progress_counter, total)
+    if scheduler.stopped:
+        journal.close()
+        logger.info('Run interrupted, ' + str(len(journal)) + ' finished documents are recorded in ' + journal_path +
+                    '. Run again with --resume True to continue')
+        logger.info('Stopping')
+        shutil.rmtree(tempfile.gettempdir() + "/PDFScraper", ignore_errors=True)
+        sys.exit(1)
+    journal.remove()
+
+
 if __name__ == "__main__":
     cli()
@@ -1,10 +1,15 @@
+import fnmatch
+import io
 import logging
+import math
 import ntpath
 import os
 import re
+import struct
 import sys
 import tempfile
-import uuid
+import time
+from collections import defaultdict, OrderedDict
 from typing import TYPE_CHECKING
 
 import camelot
@@ -12,23 +17,24 @@ import cv2
 import numpy as np
 import pytesseract
 from pypdf import PdfReader, PdfWriter
-from fuzzywuzzy import fuzz, process
+from fuzzywuzzy import fuzz, utils
 import iso639
 from langdetect import detect_langs
 from pdf2image import pdf2image
 from pdfminer.converter import PDFPageAggregator
-from pdfminer.layout import LAParams, LTTextBoxHorizontal, LTImage
-from pdfminer.pdfdocument import PDFDocument, PDFNoOutlines
+from pdfminer.layout import LAParams, LTTextBoxHorizontal, LTImage, LTTextContainer, LTFigure, LTTextLine, LTCurve
+from pdfminer.pdfdocument import PDFNoOutlines
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.pdfpage import PDFPage
-from pdfminer.pdfparser import PDFParser
 from pdfminer.pdftypes import PDFObject
 from pytesseract import TesseractNotFoundError, TesseractError
-from skimage import io
+from rapidfuzz import fuzz as rapid_fuzz, process as rapid_process
 from skimage.feature import canny
 from skimage.transform import hough_line, hough_line_peaks, rotate
 
-from PDFScraper.dataStructure import Document
+from PDFScraper import ocrEngine
+from PDFScraper.dataStructure import Document, Table, SearchResult, ImageRef
+from PDFScraper.session import DocumentSession
 
 # Set up logger
 log_level = 20
@@ -37,30 +43,134 @@ if TYPE_CHECKING:
 logger = logging.getLogger("PDFScraper")
 logger.setLevel(log_level)
 
+# default options used for layout analysis, table extraction and OCR
+LAYOUT_OPTIONS = "line_margin=0.8"
+TABLE_OPTIONS = "pages=all,flavor=lattice"
+OCR_OPTIONS = "--psm 1"
+# noise levels below which preprocessing profiles "none" and "fast" are used by the "auto" profile
+NOISE_THRESHOLDS = (3.0, 7.0)
+
+
+# extensions of images, which can be OCRed
+IMAGE_EXTENSIONS = (".bmp", ".jpg", ".pbm", ".pgm", ".ppm", ".jpeg", ".jpe", ".jp2", ".tiff", ".tif", ".png")
+# file signatures of supported images. BMP and PNM signatures are short and are checked by is_image_header
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x00\x00\x00\x0cjP  ", b"II*\x00", b"MM\x00*", b"\x89PNG\r\n\x1a\n")
+# sizes of BMP info headers of known versions
+BMP_HEADER_SIZES = (12, 40, 52, 56, 64, 108, 124)
+
+
+# Returns True if header is the beginning of a supported image
+def is_image_header(header: bytes):
+    if header.startswith(IMAGE_SIGNATURES):
+        return True
+    # PNM magic number is followed by whitespace, optional comments and the image width and height
+    if re.match(rb"P[1-6](\s+#[^\n]*)*\s+\d+\s+\d+", header):
+        return True
+    # BMP has zero reserved fields, known info header size and pixel data after the headers
+    if header.startswith(b"BM") and len(header) >= 18:
+        reserved, offset, header_size = struct.unpack("<III", header[6:18])
+        return reserved == 0 and header_size in BMP_HEADER_SIZES and offset >= 14 + header_size
+    return False
+
+
+# Returns True for PDFs, False for images and None for unsupported files.
+# With sniff, type is determined from content of the file instead of its extension
+def document_type(path: str, sniff=False):
+    if sniff:
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(1024)
+        except OSError:
+            return None
+        # PDF header can be preceded by other data
+        if b"%PDF-" in header:
+            return True
+        if is_image_header(header):
+            return False
+        return None
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".pdf":
+        return True
+    if extension in IMAGE_EXTENSIONS:
+        return False
+    return None
 
-def find_pdfs_in_path(path: str):
-    pdfs = []
-    print(path)
-    if os.path.exists(path):
 
-        if os.path.isdir(path):  # find PDFs in directory and add them to the list
-            count = 0
-            for f in os.listdir(path):
-                count += 1
-                pdfs = pdfs + find_pdfs_in_path(path + '/' + f)
+def matches_patterns(patterns, relative_path: str, name: str):
+    return any(fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
 
-        elif os.path.isfile(path) and (path.endswith(".pdf")):
-            pdfs.append(Document(path, True))
 
-        elif os.path.isfile(path) and (path.endswith(".bmp") or path.endswith(".jpg") or path.endswith(".pbm")
-                                       or path.endswith(".pgm") or path.endswith(".ppm") or path.endswith(".jpeg")
-                                       or path.endswith(".jpe") or path.endswith(".jp2") or path.endswith(".tiff")
-                                       or path.endswith(".tif") or path.endswith(".png")):
+# Returns True if file at path would be found by find_pdfs_in_path(root, ...). Used for files, which changed after the
+# path was walked, so files which no longer exist are only recognised by their extension, unless sniff is enabled
+def is_document_path(path: str, root: str, include=(), exclude=(), sniff=False):
+    if not os.path.isdir(root):
+        return os.path.abspath(path) == os.path.abspath(root)
+    relative_path = os.path.relpath(path, root)
+    parts = relative_path.split(os.sep)
+    if parts[0] == os.pardir:
+        return False
+    # file or one of its directories is excluded
+    for i in range(len(parts)):
+        if matches_patterns(exclude, os.path.join(*parts[:i + 1]), parts[i]):
+            return False
+    if len(include) > 0 and not matches_patterns(include, relative_path, parts[-1]):
+        return False
+    if document_type(path) is not None:
+        return True
+    return sniff and (not os.path.exists(path) or document_type(path, sniff) is not None)
 
-            pdfs.append(Document(path, False))
-    else:
+
+# Finds PDFs and images in path and yields them as Documents as soon as they are found, so processing can start
+# before the whole tree is walked. Patterns are matched against paths relative to path and file names. Files have to
+# match one of include patterns, if any are given, and files and directories matching exclude patterns are skipped.
+# Symbolic links are followed, but every directory is walked only once
+def find_pdfs_in_path(path: str, include=(), exclude=(), sniff=False):
+    if not os.path.exists(path):
         raise Exception("Provided path does not exist")
-    return pdfs
+    return _walk_path(path, include, exclude, sniff)
+
+
+def _walk_path(path: str, include, exclude, sniff):
+    if not os.path.isdir(path):
+        is_pdf = document_type(path, sniff)
+        if is_pdf is not None:
+            yield Document(path, is_pdf)
+        return
+    visited = set()
+    directories = [path]
+    while len(directories) > 0:
+        directory = directories.pop()
+        try:
+            stat = os.stat(directory)
+            # directory reachable through multiple symbolic links or a link loop
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            logger.warning("Could not read directory " + directory + ": " + str(e))
+            continue
+        subdirectories = []
+        for entry in entries:
+            relative_path = os.path.relpath(entry.path, path)
+            if matches_patterns(exclude, relative_path, entry.name):
+                continue
+            try:
+                if entry.is_dir():
+                    subdirectories.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            if len(include) > 0 and not matches_patterns(include, relative_path, entry.name):
+                continue
+            is_pdf = document_type(entry.path, sniff)
+            if is_pdf is not None:
+                yield Document(entry.path, is_pdf)
+        # walk subdirectories in alphabetical order
+        directories.extend(reversed(subdirectories))
 
 
 # Get filename from path
@@ -68,22 +178,29 @@ def get_filename(document: Document):
     document.filename = os.path.splitext(ntpath.basename(document.path))[0]
 
 
-# Convert document pages to jpg images
-def pdf_to_image(document: Document):
-    tempfile_path = tempfile.gettempdir() + "/PDFScraper"
-    try:
-        os.makedirs(tempfile_path)
-    except FileExistsError:
-        pass
+# Convert PIL image from pdf2image to OpenCV (BGR) image
+def pil_to_cv2(image):
+    return cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
 
-    if document.is_pdf:
-        pages = pdf2image.convert_from_path(pdf_path=document.path, dpi=300)
-        # TODO: implement saving to temp dir with mkstemp for better security
-        for i in range(len(pages)):
-            pages[i].save(tempfile_path + "/" + document.filename + "_" + str(i) + ".jpg")
-    else:
-        img = cv2.imread(document.path)
-        cv2.imwrite(tempfile_path + "/" + document.filename + "_0.jpg", img)
+
+# Render document page by page, keeping at most window pages in memory at once.
+# pages limits rendering to given page numbers, by default all pages are rendered
+def iter_page_images(document: Document, window=1, dpi=300, pages=None):
+    if not document.is_pdf:
+        yield cv2.imread(document.path)
+        return
+    if pages is None:
+        pages = range(1, document.num_pages + 1)
+    pages = list(pages)
+    while len(pages) > 0:
+        # render consecutive pages together
+        first_page = last_page = pages.pop(0)
+        while len(pages) > 0 and pages[0] == last_page + 1 and last_page - first_page + 1 < window:
+            last_page = pages.pop(0)
+        images = pdf2image.convert_from_path(pdf_path=document.path, dpi=dpi, first_page=first_page,
+                                             last_page=last_page)
+        while len(images) > 0:
+            yield pil_to_cv2(images.pop(0))
 
 
 # helper function for preserving aspect ration when resizing
@@ -208,8 +325,53 @@ def determine_skew(image, sigma=3.0, num_peaks=20):
     return ans_res
 
 
-# Apply deskewing to the image
-def deskew(image):
+# Estimate skew on a downscaled image with projection profiles. Rows of a correctly rotated page alternate between
+# text lines and empty space, so the angle with the sharpest horizontal projection profile is chosen.
+# Returns the angle in degrees, by which the image has to be rotated counter-clockwise
+def determine_skew_fast(image, max_angle=10.0, width=800):
+    if image.shape[1] > width:
+        image = image_resize(image, width=width)
+    # text pixels have high values in the inverted image
+    image = 255 - image
+
+    def profile_score(angle):
+        (h, w) = image.shape[:2]
+        matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+        rotated = cv2.warpAffine(image, matrix, (w, h), flags=cv2.INTER_NEAREST, borderValue=0)
+        profile = rotated.sum(axis=1, dtype=np.float64)
+        return np.sum(np.diff(profile) ** 2)
+
+    # coarse search over the whole range, followed by a fine search around the best angle
+    angles = np.arange(-max_angle, max_angle + 0.5, 0.5)
+    best = angles[np.argmax([profile_score(angle) for angle in angles])]
+    angles = np.arange(best - 0.5, best + 0.55, 0.1)
+    return float(angles[np.argmax([profile_score(angle) for angle in angles])])
+
+
+# Rotate 8-bit image counter-clockwise, expanding it so no content is cut off
+def rotate_image(image, angle):
+    (h, w) = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_w = int(round(h * sin + w * cos))
+    new_h = int(round(h * cos + w * sin))
+    matrix[0, 2] += new_w / 2 - w / 2
+    matrix[1, 2] += new_h / 2 - h / 2
+    return cv2.warpAffine(image, matrix, (new_w, new_h), flags=cv2.INTER_LINEAR, borderValue=255)
+
+
+# Apply deskewing to the 8-bit grayscale image.
+# Mode "fast" uses determine_skew_fast, "accurate" the Hough transform based determine_skew and "none" skips deskewing.
+# Rotations smaller than min_angle are skipped
+def deskew(image, mode="accurate", min_angle=0.1):
+    if mode == "none":
+        return image
+    if mode == "fast":
+        rot_angle = determine_skew_fast(image)
+        if abs(rot_angle) < min_angle:
+            return image
+        return rotate_image(image, rot_angle)
+
     angle = determine_skew(image)
     if 0 <= angle <= 90:
         rot_angle = angle - 90
@@ -217,137 +379,313 @@ def deskew(image):
         rot_angle = angle - 90
     if -90 <= angle < -45:
         rot_angle = 90 + angle
+    if abs(rot_angle) < min_angle:
+        return image
 
-    return rotate(image, rot_angle, resize=True)
+    return (rotate(image, rot_angle, resize=True) * 255).astype(np.uint8)
 
 
-def preprocess_image(image):
-    # Denoising
-    image = cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 15)
-    # RGB to grayscale
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+# Estimate standard deviation of noise in grayscale image using Immerkaer's method.
+# Only the center of the page is measured, which is enough to tell clean scans from noisy ones
+def estimate_noise(image, size=1024):
+    (h, w) = image.shape[:2]
+    top, left = max(0, (h - size) // 2), max(0, (w - size) // 2)
+    image = image[top:top + size, left:left + size].astype(np.float64)
+    (h, w) = image.shape[:2]
+    if h < 3 or w < 3:
+        return 0.0
+    kernel = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float64)
+    laplacian = cv2.filter2D(image, -1, kernel)[1:-1, 1:-1]
+    return float(np.sum(np.abs(laplacian)) * np.sqrt(0.5 * np.pi) / (6 * (w - 2) * (h - 2)))
+
+
+# Pick preprocessing profile for the image based on its noise level
+def select_profile(image, thresholds=NOISE_THRESHOLDS):
+    noise = estimate_noise(image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+    if noise < thresholds[0]:
+        return "none"
+    if noise < thresholds[1]:
+        return "fast"
+    return "full"
+
+
+# Add time elapsed since start to the stage in timings and return current time
+def record_timing(timings, stage: str, start: float):
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + now - start
+    return now
+
+
+# Profile "full" denoises colour image with non-local means, "fast" converts to grayscale first and applies median
+# filter, "none" only converts to grayscale and "auto" picks one of them based on the noise in the image.
+# Time spent in every stage is added to timings, when provided
+def preprocess_image(image, deskew_mode="accurate", profile="full", timings=None):
+    start = time.perf_counter()
+    if profile == "auto":
+        profile = select_profile(image)
+        logger.debug("Using " + profile + " preprocessing profile")
+        start = record_timing(timings, "profile", start)
+    # Denoising and RGB to grayscale
+    if profile == "full":
+        image = cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 15)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if profile == "fast":
+        image = cv2.medianBlur(image, 3)
+    start = record_timing(timings, "denoise", start)
     # Thresholding
     # image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
     image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-    # save and reread to convert to scikit-image image type
-    temp_image_path = tempfile.gettempdir() + "/PDFScraper" + "/" + str(uuid.uuid4()) + "deskew.jpg"
-    cv2.imwrite(temp_image_path, image)
-    image = io.imread(temp_image_path)
-    os.remove(temp_image_path)
-    image = deskew(image)
-    image = image * 255
-    io.imsave(temp_image_path, image.astype(np.uint8))
-    image = cv2.imread(temp_image_path)
-    os.remove(temp_image_path)
-    return image
-
-
-# Preprocess the images for OCR then extract them
-def convert_to_pdf(document: Document, tessdata_location: str, config_options=""):
+    start = record_timing(timings, "threshold", start)
+    image = deskew(image, deskew_mode)
+    record_timing(timings, "deskew", start)
+    # back to 3 channel image used by OpenCV
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+
+# Render single page of the document as OpenCV (BGR) image
+def render_page(document: Document, page: int, dpi=300):
+    if not document.is_pdf:
+        return cv2.imread(document.path)
+    image = pdf2image.convert_from_path(pdf_path=document.path, dpi=dpi, first_page=page + 1, last_page=page + 1)[0]
+    return pil_to_cv2(image)
+
+
+# Run OCR on preprocessed image of a page rendered at dpi. Returns Tesseract TSV with boxes of recognised words and,
+# when pdf is True, single page PDF with text layer, otherwise None.
+# backend selects how Tesseract is run. tesserocr keeps engines loaded in the process and reuses them for every page,
+# pytesseract starts a tesseract process for every call and auto uses tesserocr when it is installed
+def ocr_image(img, language: str, tessdata_location: str, config_options="", backend="auto", pdf=False, dpi=300):
+    # uses provided config if available
+    if config_options == "":
+        config_options = OCR_OPTIONS + ' --tessdata-dir ' + tessdata_location
+    config_options += ' --dpi ' + str(dpi)
+    try:
+        if ocrEngine.use_engine(backend, config_options):
+            if not pdf:
+                return ocrEngine.image_to_data(img, language, config_options), None
+            # both outputs come from a single recognition pass
+            pdf_page, tsv = ocrEngine.image_to_pdf_and_data(img, language, config_options)
+            return tsv, pdf_page
+    except RuntimeError as e:
+        if backend != "auto":
+            raise TesseractError(1, str(e))
+    tsv = pytesseract.image_to_data(img, lang=language, config=config_options)
+    pdf_page = None
+    if pdf:
+        pdf_page = pytesseract.image_to_pdf_or_hocr(img, extension='pdf', lang=language, config=config_options)
+    return tsv, pdf_page
+
+
+# fix Slovene chars and other anomalies
+def clean_text(text: str):
+    text = re.sub(r'ˇs', "š", text)
+    text = re.sub(r"ˇc", "č", text)
+    text = re.sub(r"ˇz", "ž", text)
+    return re.sub(r"-\s", "", text)
+
+
+# Groups words of Tesseract TSV output into paragraphs. Returns list of (text, bbox) pairs, where bbox is in PDF points
+# with origin in the bottom left corner, same as bounding boxes of pdfminer layouts of a page rendered at dpi
+def tsv_paragraphs(tsv: str, dpi=300):
+    page_height = 0
+    # (block, paragraph) -> words of every line and boxes of the words, in reading order
+    paragraphs = {}
+    for row in tsv.splitlines():
+        fields = row.split("\t")
+        # skips the header
+        if len(fields) < 12 or not fields[0].isdigit():
+            continue
+        left, top, width, height = (int(field) for field in fields[6:10])
+        if fields[0] == "1":
+            page_height = top + height
+        if fields[0] != "5" or fields[11].strip() == "":
+            continue
+        lines, boxes = paragraphs.setdefault((fields[2], fields[3]), ({}, []))
+        lines.setdefault(fields[4], []).append(fields[11])
+        boxes.append((left, top, left + width, top + height))
+    scale = 72 / dpi
+    result = []
+    for lines, boxes in paragraphs.values():
+        text = "\n".join(" ".join(words) for words in lines.values()) + "\n"
+        x0, top = min(box[0] for box in boxes), min(box[1] for box in boxes)
+        x1, bottom = max(box[2] for box in boxes), max(box[3] for box in boxes)
+        result.append((clean_text(text), (x0 * scale, (page_height - bottom) * scale, x1 * scale,
+                                          (page_height - top) * scale)))
+    return result
+
+
+# Merge single page PDFs produced by OCR into one document and use it for further extraction.
+# PDF is written to path, by default to a temporary file
+def merge_pdf_pages(document: Document, pdf_pages, path=None):
+    pdf_writer = PdfWriter()
+    for pdf_page in pdf_pages:
+        for page in PdfReader(io.BytesIO(pdf_page)).pages:
+            pdf_writer.add_page(page)
+    if path is None:
+        tempfile_path = tempfile.gettempdir() + "/PDFScraper"
+        os.makedirs(tempfile_path, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=tempfile_path, prefix=document.filename + "_", suffix=".pdf")
+        os.close(fd)
+    with open(path, 'w+b') as out:
+        pdf_writer.write(out)
+    document.ocr_path = path
+
+
+# Preprocess the images for OCR then extract them. Returns paragraphs of every page as returned by tsv_paragraphs.
+# Images are OpenCV images of the pages, by default pages are rendered one by one with iter_page_images
+# Language is the Tesseract language of all pages, by default the language chosen for the document is used.
+# Searchable PDF of the OCRed pages is only built when pdf_path is given, it is then used for table extraction
+def ocr_document(document: Document, tessdata_location: str, config_options="", images=None,
+                 deskew_mode="accurate", profile="full", timings=None, backend="auto", language=None, pdf_path=None):
+    if language is None:
+        language = document.ocr_language or "eng"
+    if images is None:
+        images = iter_page_images(document)
+    page_paragraphs = []
     pdf_pages = []
-    for i in range(document.num_pages):
-        img = cv2.imread(tempfile.gettempdir() + "/PDFScraper" + "/" + document.filename + "_" + str(i) + ".jpg")
-        # remove temporary image file
-        os.remove(tempfile.gettempdir() + "/PDFScraper" + "/" + document.filename + "_" + str(i) + ".jpg")
+    start = time.perf_counter()
+    for i, img in enumerate(images):
+        record_timing(timings, "render", start)
+        if img is None:
+            logger.warning("Could not read image " + document.path + ", skipping it")
+            page_paragraphs.append([])
+            pdf_pages.append(None)
+            continue
         # Resize imput image if not PDF
         # if not document.isPDF:
         #     img = image_resize(img, width=1024)
 
-        img = preprocess_image(img)
-
-        # Extract language from the first page only
-        if i == 0:
-            language = get_language(img, tessdata_location)
-            # if not english or slovene set to english
-            if language != "eng" or language != "slv":
-                language = "eng"
+        img = preprocess_image(img, deskew_mode, profile, timings)
 
         try:
-            # uses provided config if available
-            if config_options == "":
-                config_options = '--psm 1 --tessdata-dir ' + tessdata_location
-            text = pytesseract.image_to_pdf_or_hocr(img, extension='pdf', lang=language, config=config_options)
-            with open(tempfile.gettempdir() + "/PDFScraper" + "/" + document.filename + "_" + str(i) + ".pdf",
-                      'w+b') as f:
-                f.write(text)
-                pdf_pages.append(
-                    tempfile.gettempdir() + "/PDFScraper" + "/" + document.filename + "_" + str(i) + ".pdf")
+            start = time.perf_counter()
+            tsv, pdf_page = ocr_image(img, language, tessdata_location, config_options, backend, pdf_path is not None)
+            page_paragraphs.append(tsv_paragraphs(tsv))
+            pdf_pages.append(pdf_page)
+            start = record_timing(timings, "ocr", start)
         except TesseractNotFoundError:
             logger.error("Tesseract is not installed. Exiting")
             sys.exit(1)
         except TesseractError as e:
             logger.error(e)
             sys.exit(1)
-    pdf_writer = PdfWriter()
-    pdf_files = []
-    for filename in pdf_pages:
-        pdf_file = open(filename, 'rb')
-        pdf_files.append(pdf_file)
-        pdf_reader = PdfReader(pdf_file)
-        for i in range(pdf_reader.numPages):
-            page = pdf_reader.getPage(i)
-            pdf_writer.addPage(page)
-    with open(tempfile.gettempdir() + "/PDFScraper" + "/" + document.filename + ".pdf", 'w+b') as out:
-        pdf_writer.write(out)
-        out.close()
-        document.ocr_path = tempfile.gettempdir() + "/PDFScraper" + "/" + document.filename + ".pdf"
-    # cleanup temporary files
-    for file, filename in zip(pdf_files, pdf_pages):
-        file.close()
-        os.remove(filename)
-
-
-# get language from text
-def get_language(img, tessdata_location: str):
-    # TODO: Implement input parameter for specifying possible languages. Slovene and english by default.
-    config = r'-l eng+slv --psm 6' + ' --tessdata-dir ' + tessdata_location
+    if pdf_path is not None and None not in pdf_pages:
+        merge_pdf_pages(document, pdf_pages, pdf_path)
+    return page_paragraphs
+
+
+# get language from text.
+# languages are Tesseract languages used for OCR of the image, for example "eng+slv"
+def get_language(img, tessdata_location: str, backend="auto", languages="eng+slv"):
+    config = r'-l ' + languages + ' --psm 6' + ' --tessdata-dir ' + tessdata_location
     try:
-        text = pytesseract.image_to_string(img, config=config)
+        text = None
+        try:
+            if ocrEngine.use_engine(backend, config):
+                text = ocrEngine.image_to_string(img, config)
+        except RuntimeError as e:
+            if backend != "auto":
+                raise TesseractError(1, str(e))
+        if text is None:
+            text = pytesseract.image_to_string(img, config=config)
     except TesseractNotFoundError:
         logger.error("Tesseract is not installed. Exiting")
         sys.exit(1)
     except TesseractError as e:
         logger.error(e)
         sys.exit(1)
-    # Assume that all pages contain the same language
-    # Detect language from extracted text
-    detected_languages = detect_langs(text)
-    # Convert iso-639-2b to iso-639-2t
-    language = iso639.Language.from_part1(detected_languages[0].lang)
-    return language.part2t
+    return language_from_text(text)
 
 
-# parses Document to PDFDocument
-def get_pdf_object(document: Document):
-    if document.filename is None:
-        get_filename(document)
-    # use OCR processed file if available
-    file = open(document.ocr_path, 'rb')
-    parser = PDFParser(file)
-    pdf_object = PDFDocument(parser)
-    parser.set_document(pdf_object)
-
-    if pdf_object.is_extractable:
-        document.extractable = True
-    return pdf_object
-
-
-def extract_info(document: Document):
+# Detects language of text and returns it as ISO 639-2/T code, which is used by Tesseract.
+# Returns None if language can not be detected
+def language_from_text(text: str):
+    try:
+        detected_languages = detect_langs(text)
+        # Convert iso-639-1 to iso-639-2t
+        return iso639.Language.from_part1(detected_languages[0].lang).part2t
+    except Exception:
+        return None
+
+
+# Returns grayscale band across the middle of the page, which contains enough text to detect language
+def language_sample(img):
+    height = img.shape[0]
+    img = img[height // 4:height - height // 4]
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return img
+
+
+# Languages detected for directories and producers, so documents of the same corpus are only detected once.
+# Least recently used entries are dropped, so the cache does not grow with the number of directories
+language_cache = OrderedDict()
+LANGUAGE_CACHE_SIZE = 1024
+
+
+def cached_language(keys):
+    for key in keys:
+        if key in language_cache:
+            language_cache.move_to_end(key)
+            return language_cache[key]
+    return None
+
+
+def cache_language(key, language):
+    language_cache[key] = language
+    language_cache.move_to_end(key)
+    if len(language_cache) > LANGUAGE_CACHE_SIZE:
+        language_cache.popitem(last=False)
+
+
+# Chooses one of the languages for OCR of the document.
+# Language is detected from the text layer of pages, which do not need OCR, if there is enough of it, otherwise it is
+# taken from the language cache or detected from a sample of the first OCR page, which is rendered at the resolution
+# used for OCR.
+# When language can not be detected, all languages are used together
+def detect_language(document: Document, tessdata_location: str, languages="eng", backend="auto", min_text=200,
+                    dpi=300):
+    candidates = languages.split("+")
+    if len(candidates) == 1:
+        return languages
+    keys = [("directory", os.path.dirname(document.path))]
+    if document.info.producer not in (None, "", "unknown"):
+        keys.append(("producer", document.info.producer))
+    text = "\n".join(document.paragraphs)
+    language = language_from_text(text) if len(text) >= min_text else None
+    if language not in candidates:
+        language = cached_language(keys)
+    if language is None:
+        page = document.ocr_pages[0] if len(document.ocr_pages) > 0 else 1
+        img = render_page(document, page - 1, dpi)
+        if img is None:
+            return languages
+        language = get_language(language_sample(img), tessdata_location, backend, languages)
+    if language not in candidates:
+        return languages
+    for key in keys:
+        cache_language(key, language)
+    return language
+
+
+# Reads number of pages and metadata. Opens the document, unless it is already open in the provided session
+def extract_info(document: Document, session: DocumentSession = None):
     if document.filename is None:
         get_filename(document)
     if document.is_pdf:
-        with open(document.path, 'rb') as f:
-            pdf = PdfReader(f, strict=False)
-            # TODO: Handle encrypted files
-
-            document.num_pages = len(pdf.pages)
-            informations = pdf.metadata
-            if informations is not None:
-                document.info.author = "unknown" if not informations.author else informations.author
-                document.info.creator = "unknown" if not informations.creator else informations.creator
-                document.info.producer = "unknown" if not informations.producer else informations.producer
-                document.info.subject = "unknown" if not informations.subject else informations.subject
-                document.info.title = "unknown" if not informations.title else informations.title
+        if session is None:
+            with DocumentSession(document.path) as session:
+                return extract_info(document, session)
+        # TODO: Handle encrypted files
+        document.num_pages = session.num_pages
+        informations = session.metadata()
+        document.info.author = informations.get("Author") or "unknown"
+        document.info.creator = informations.get("Creator") or "unknown"
+        document.info.producer = informations.get("Producer") or "unknown"
+        document.info.subject = informations.get("Subject") or "unknown"
+        document.info.title = informations.get("Title") or "unknown"
     else:
         document.num_pages = 1
         document.info.author = "unknown"
@@ -357,8 +695,23 @@ def extract_info(document: Document):
         document.info.title = "unknown"
 
 
-# layout analysis for every page
-def extract_page_layouts(pdf_object: PDFObject, config_options="line_margin=0.8"):
+# Returns sorted page numbers selected by ranges like "1-3,5,10-", limited to pages of the document
+def parse_page_ranges(ranges: str, num_pages: int):
+    pages = set()
+    for page_range in ranges.split(','):
+        start, _, end = page_range.strip().partition('-')
+        start = int(start) if start else 1
+        # ranges open at the end, like "10-", may start after the last page and are empty
+        if end and int(end) < start:
+            raise ValueError("Page range " + page_range + " ends before it starts")
+        end = (int(end) if end else num_pages) if '-' in page_range else start
+        pages.update(range(max(1, start), min(end, num_pages) + 1))
+    return sorted(pages)
+
+
+# layout analysis for every page, yields page number and layout of one page at a time, so layouts of previous pages
+# can be released. pages limits analysis to the given page numbers
+def iter_page_layouts(pdf_object: PDFObject, config_options=LAYOUT_OPTIONS, pages=None):
     # converts config_options, which is a string to dictionary, so it can be passed as **kwargs to camelot
     args = dict(e.split('=') for e in config_options.split(','))
     for key in args:
@@ -370,11 +723,16 @@ def extract_page_layouts(pdf_object: PDFObject, config_options="line_margin=0.8"
     laparams = LAParams(**args)
     page_aggregator = PDFPageAggregator(resource_manager, laparams=laparams)
     interpreter = PDFPageInterpreter(resource_manager, page_aggregator)
-    page_layouts = []
-    for page in PDFPage.create_pages(pdf_object):
+    if pages is not None:
+        pages = set(pages)
+    last_page = max(pages, default=0) if pages is not None else None
+    for page_number, page in enumerate(PDFPage.create_pages(pdf_object), 1):
+        if last_page is not None and page_number > last_page:
+            break
+        if pages is not None and page_number not in pages:
+            continue
         interpreter.process_page(page)
-        page_layouts.append(page_aggregator.get_result())
-    return page_layouts
+        yield page_number, page_aggregator.get_result()
 
 
 def extract_table_of_contents(document: Document, pdf_object):
@@ -400,54 +758,154 @@ def doOverlap(l1, r1, l2, r2):
     return True
 
 
-# extracts LTTextBoxHorizontal and LTImage from layouts
-def parse_layouts(document: Document, page_layouts):
-    count = 1
-    for page_layout in page_layouts:
-        parse_elements(document, page_layout, count)
-        count = count + 1
+# Returns True if page has no text layer and is mostly covered by images, so its text can only be extracted with OCR
+def page_needs_ocr(page_layout, min_image_coverage=0.5, max_text_coverage=0.01):
+    page_area = page_layout.width * page_layout.height
+    if page_area <= 0:
+        return False
+
+    def covered_areas(elements):
+        text_area, image_area = 0, 0
+        for element in elements:
+            if isinstance(element, LTTextContainer):
+                if element.get_text().strip():
+                    text_area += element.width * element.height
+            elif isinstance(element, LTImage):
+                image_area += element.width * element.height
+            elif isinstance(element, LTFigure):
+                figure_text_area, figure_image_area = covered_areas(element)
+                text_area += figure_text_area
+                image_area += figure_image_area
+        return text_area, image_area
+
+    text_area, image_area = covered_areas(page_layout)
+    return image_area / page_area >= min_image_coverage and text_area / page_area < max_text_coverage
+
+
+# Returns True if page layout looks like it contains a table, so only such pages are passed to camelot.
+# Lattice tables are drawn with ruling lines, which pdfminer reports as LTLine, LTRect and LTCurve.
+# Stream tables have no lines, but have rows of separate text lines whose left edges are aligned in columns.
+def page_may_contain_table(page_layout, flavor="lattice", min_rows=3, min_columns=3, tolerance=2.0):
+    horizontal, vertical = 0, 0
+    text_lines = []
+
+    def collect(elements):
+        nonlocal horizontal, vertical
+        for element in elements:
+            # LTLine and LTRect are subclasses of LTCurve
+            if isinstance(element, LTCurve):
+                if element.height <= tolerance and element.width > tolerance:
+                    horizontal += 1
+                elif element.width <= tolerance and element.height > tolerance:
+                    vertical += 1
+                elif element.width > tolerance and element.height > tolerance:
+                    # rectangle has two horizontal and two vertical edges
+                    horizontal += 2
+                    vertical += 2
+            elif isinstance(element, LTTextLine):
+                if element.get_text().strip():
+                    text_lines.append(element)
+            elif isinstance(element, (LTTextContainer, LTFigure)):
+                collect(element)
+
+    collect(page_layout)
+    if horizontal >= 2 and vertical >= 2:
+        return True
+    # camelot's lattice flavor only detects tables with ruling lines
+    if flavor == "lattice":
+        return False
+    rows = defaultdict(list)
+    for line in text_lines:
+        rows[round((line.y0 + line.y1) / 2 / tolerance)].append(line)
+    columns = defaultdict(int)
+    for row in rows.values():
+        if len(row) >= min_columns:
+            for x0 in set(round(line.x0 / tolerance) for line in row):
+                columns[x0] += 1
+    return sum(1 for count in columns.values() if count >= min_rows) >= min_columns
+
+
+# Spatial index of table bounding boxes. Every page is divided into a grid of cells and every cell stores tables
+# covering it, so only tables near an element are checked for overlap
+class TableIndex:
+    def __init__(self, tables, cell_size=50.0):
+        self.cell_size = cell_size
+        self.bboxes = []
+        self.grid = defaultdict(list)
+        for table in tables:
+            # camelot tables store bounding box in _bbox
+            bbox = table.bbox if isinstance(table, Table) else table._bbox
+            table_id = len(self.bboxes)
+            self.bboxes.append(bbox)
+            # camelot stores page numbers as strings
+            page = int(table.page)
+            for cell in self._cells(bbox):
+                self.grid[(page,) + cell].append(table_id)
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def _cells(self, bbox):
+        x0, y0, x1, y1 = (int(math.floor(coordinate / self.cell_size)) for coordinate in bbox)
+        return ((column, row) for column in range(x0, x1 + 1) for row in range(y0, y1 + 1))
+
+    # Returns True if the bounding box overlaps any table on the page
+    def overlaps(self, page: int, bbox):
+        checked = set()
+        for cell in self._cells(bbox):
+            for table_id in self.grid.get((page,) + cell, ()):
+                if table_id in checked:
+                    continue
+                checked.add(table_id)
+                table_bbox = self.bboxes[table_id]
+                if doOverlap((bbox[0], bbox[3]), (bbox[2], bbox[1]), (table_bbox[0], table_bbox[3]),
+                             (table_bbox[2], table_bbox[1])):
+                    return True
+        return False
 
 
-# Recursively iterate over all the lt elements from pdfminer.six
-def parse_elements(document, page_layout, page):
+# Recursively iterate over all the lt elements from pdfminer.six.
+# table_index should be built once after tables are extracted, otherwise it is built from document.tables
+def parse_elements(document, page_layout, page, table_index=None):
+    if table_index is None:
+        table_index = TableIndex(document.tables)
     for element in page_layout:
-        # TODO: improve efficiency
         # extract text and images if there is no table in that location
         skip = False
-        if len(document.tables) > 0 and hasattr(element, "x0"):
-            for table in document.tables:
-                # skip if element is inside already detected table
-                if (table.page == page and doOverlap((element.x0, element.y1), (element.x1, element.y0),
-                                                     (table._bbox[0], table._bbox[3]),
-                                                     (table._bbox[2], table._bbox[1]))):
-                    skip = True
-                    break
+        if len(table_index) > 0 and hasattr(element, "x0"):
+            # skip if element is inside already detected table
+            skip = table_index.overlaps(page, (element.x0, element.y0, element.x1, element.y1))
         if not skip:
             if isinstance(element, LTTextBoxHorizontal):
-                text = element.get_text()
-                # fix Slovene chars and other anomalies
-                text = re.sub(r'ˇs', "š", text)
-                text = re.sub(r"ˇc", "č", text)
-                text = re.sub(r"ˇz", "ž", text)
-                text = re.sub(r"-\s", "", text)
-                document.paragraphs.append(text)
+                document.add_paragraph(clean_text(element.get_text()), page, element.bbox)
             elif isinstance(element, LTImage):
-                # Save image objects
-                document.images.append(element)
+                # Save location of image objects, images are not kept in memory
+                document.images.append(ImageRef(page, element.bbox, getattr(element.stream, "objid", None)))
         elif hasattr(element, '_objs'):
             for el in element._objs:
                 if hasattr(el, '__iter__'):
-                    parse_elements(document, el, page)
+                    parse_elements(document, el, page, table_index)
 
 
-def extract_tables(document: Document, config_options="pages=all,flavor=lattice,parallel=True"):
-    # converts config_options, which is a string to dictionary, so it can be passed as **kwargs to camelot
+# converts config_options, which is a string to dictionary, so it can be passed as **kwargs to camelot
+def parse_table_options(config_options=TABLE_OPTIONS):
     args = dict(e.split('=') for e in config_options.split(','))
     for key in args:
         try:
             args[key] = int(args[key])
         except ValueError:
             pass
+    return args
+
+
+# pages limits extraction to the given page numbers, overriding pages in config_options
+def extract_tables(document: Document, config_options=TABLE_OPTIONS, pages=None):
+    args = parse_table_options(config_options)
+    if pages is not None:
+        if len(pages) == 0:
+            document.tables = []
+            return
+        args['pages'] = ','.join(str(page) for page in pages)
     # use new OCR path if available
     tables = camelot.read_pdf(document.ocr_path, **args)
     # remove tables with bad accuracy
@@ -455,48 +913,96 @@ def extract_tables(document: Document, config_options="pages=all,flavor=lattice,
     document.tables = tables
 
 
-def find_words_paragraphs(paragraphs, search_mode, search_words, match_score):
-    result = []
-    for paragraph in paragraphs:
-        # split paragraph into sentences.
-        split = paragraph.split(".")
-        for word in search_words:
-            found = False
-            for string in split:
-                if (len(word) <= len(string)) and fuzz.partial_ratio(word, string) > match_score:
-                    found = True
-                    break
-            # exit after finding first match when or mode is selected
-            if found and not search_mode:
-                break
-            # exit if one of words was not Found in and mode
-            if not found and search_mode:
-                break
-        if found:
-            result.append(paragraph)
-    return result
-
-
-def find_words_tables(tables, search_mode, search_words, match_score):
-    result = []
-    for table in tables:
-        table.df[0].str.strip('.!? \n\t')
-        # perform fuzzy search over all columns
-        found = False
-        for i in range(0, table.shape[1]):
-            if found:
-                break
-            for x in process.extract(search_words[0], table.df[i].astype(str).values.tolist(),
-                                     scorer=fuzz.partial_ratio):
-                if x[1] > 80:
-                    found = True
-                    break
-            # exit after finding first match when or mode is selected
-            if found and not search_mode:
-                break
-            # exit if one of words was not Found in and mode
-            if not found and search_mode:
-                break
-        if found:
-            result.append(table)
-    return result
+# Returns matrix with a row for every search word and a column for every string, which contains fuzzywuzzy's partial
+# ratio of the word and the string where it exceeds match_score and -1 elsewhere.
+# All pairs are scored at once by rapidfuzz using all cores. rapidfuzz's partial_ratio checks every alignment, so it
+# is never lower than fuzzywuzzy's, which only checks alignments at matching blocks. Pairs above the cutoff are then
+# confirmed with fuzzywuzzy, so matches are the same as with fuzzywuzzy alone.
+def score_matrix(search_words, strings, match_score, workers=-1):
+    matches = np.full((len(search_words), len(strings)), -1, dtype=np.int16)
+    # rounded score has to exceed match_score
+    cutoff = max(0, match_score + 0.5)
+    if len(search_words) == 0 or len(strings) == 0 or cutoff > 100:
+        return matches
+    scores = rapid_process.cdist(search_words, strings, scorer=rapid_fuzz.partial_ratio, score_cutoff=cutoff,
+                                 workers=workers)
+    candidates = scores >= cutoff
+    for row, word in enumerate(search_words):
+        # fuzzywuzzy scores equal strings with 100, even if they are empty
+        if word == "":
+            candidates[row] = [string == "" for string in strings]
+    for row, column in zip(*np.nonzero(candidates)):
+        score = fuzz.partial_ratio(search_words[row], strings[column])
+        if score > match_score:
+            matches[row, column] = score
+    return matches
+
+
+# Returns positions of paragraphs, in which all (and mode) or any (or mode) of search words are found, and their scores.
+# Word is found in paragraph if fuzzy partial ratio with one of its sentences exceeds match_score, score of the word is
+# its best ratio and score of the paragraph is the lowest score of words in and mode and the highest in or mode.
+# Sentences of all paragraphs are scored against all words at once.
+def paragraph_hits(paragraphs, search_mode, search_words, match_score, workers=-1):
+    if len(search_words) == 0 or len(paragraphs) == 0:
+        return [], []
+    sentences = []
+    # index of the paragraph for every sentence
+    paragraph_ids = []
+    for paragraph_id, paragraph in enumerate(paragraphs):
+        for sentence in paragraph.split("."):
+            sentences.append(sentence)
+            paragraph_ids.append(paragraph_id)
+    scores = score_matrix(search_words, sentences, match_score, workers=workers)
+    # score of word in paragraph is its best score in any of the sentences
+    paragraph_scores = np.full((len(search_words), len(paragraphs)), -1, dtype=np.int16)
+    rows, columns = np.nonzero(scores >= 0)
+    np.maximum.at(paragraph_scores, (rows, np.array(paragraph_ids, dtype=int)[columns]), scores[rows, columns])
+    found = paragraph_scores >= 0
+    if search_mode:
+        positions = np.nonzero(found.all(axis=0))[0]
+        hit_scores = paragraph_scores[:, positions].min(axis=0)
+    else:
+        positions = np.nonzero(found.any(axis=0))[0]
+        hit_scores = paragraph_scores[:, positions].max(axis=0)
+    return positions.tolist(), hit_scores.tolist()
+
+
+# Returns paragraphs, in which all (and mode) or any (or mode) of search words are found
+def find_words_paragraphs(paragraphs, search_mode, search_words, match_score, workers=-1):
+    positions, _ = paragraph_hits(paragraphs, search_mode, search_words, match_score, workers)
+    return [paragraphs[position] for position in positions]
+
+
+# Returns positions of tables, which contain the first search word, and their scores, which are the best scores of
+# their cells. In and mode only the first column of a table is searched, in or mode all of them.
+# Cells of all tables are scored in a single batch.
+def table_hits(tables, search_mode, search_words, match_score, workers=-1):
+    cells = []
+    owners = []
+    for table_id, table in enumerate(tables):
+        columns = range(min(1, table.shape[1])) if search_mode else range(table.shape[1])
+        for i in columns:
+            column = [utils.full_process(cell) for cell in table.df[i].astype(str).values.tolist()]
+            cells.extend(column)
+            owners.extend([table_id] * len(column))
+    scores = score_matrix([utils.full_process(search_words[0])], cells, match_score, workers=workers)[0]
+    table_scores = np.full(len(tables), -1, dtype=np.int16)
+    np.maximum.at(table_scores, np.array(owners, dtype=int), scores)
+    positions = np.nonzero(table_scores >= 0)[0]
+    return positions.tolist(), table_scores[positions].tolist()
+
+
+# Returns tables, which contain the first search word
+def find_words_tables(tables, search_mode, search_words, match_score, workers=-1):
+    positions, _ = table_hits(tables, search_mode, search_words, 80, workers)
+    return [tables[position] for position in positions]
+
+
+# Returns paragraphs and tables of the document, which contain search words, with their positions and scores
+def search_document(document: Document, search_words, search_mode, match_score=80, workers=-1):
+    paragraph_positions, paragraph_scores = paragraph_hits(document.paragraphs, search_mode, search_words,
+                                                           match_score, workers)
+    table_positions, table_scores = table_hits(document.tables, search_mode, search_words, 80, workers)
+    return SearchResult(document.path, [document.paragraphs[position] for position in paragraph_positions],
+                        [document.tables[position] for position in table_positions], paragraph_positions,
+                        paragraph_scores, table_positions, table_scores)
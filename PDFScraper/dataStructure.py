@@ -1,13 +1,70 @@
+import math
+from array import array
+
+import pandas as pd
+
+
+class Table:
+    # plain table, which only keeps cell contents and location of the table.
+    # Provides the parts of camelot's Table interface used for searching and output generation
+    __slots__ = ("page", "bbox", "cells")
+
+    def __init__(self, page: int, bbox, cells):
+        self.page = page
+        self.bbox = tuple(bbox)
+        self.cells = cells
+
+    def __getstate__(self):
+        return self.page, self.bbox, self.cells
+
+    def __setstate__(self, state):
+        self.page, self.bbox, self.cells = state
+
+    @classmethod
+    def from_camelot(cls, table):
+        return cls(int(table.page), table._bbox, table.df.astype(str).values.tolist())
+
+    @property
+    def df(self):
+        return pd.DataFrame(self.cells)
+
+    @property
+    def shape(self):
+        return len(self.cells), max((len(row) for row in self.cells), default=0)
+
+
+class ImageRef:
+    # location of an image in the document, the image itself is read from the PDF object with xref when it is needed
+    __slots__ = ("page", "bbox", "xref")
+
+    def __init__(self, page: int, bbox, xref=None):
+        self.page = page
+        self.bbox = tuple(bbox)
+        self.xref = xref
+
+    def __getstate__(self):
+        return self.page, self.bbox, self.xref
+
+    def __setstate__(self, state):
+        self.page, self.bbox, self.xref = state
+
+
 class Document:
     # general info about document
     class Info:
+        __slots__ = ("author", "creator", "producer", "subject", "title", "table_of_contents")
+
         def __init__(self):
             self.author = "unknown"
+            self.creator = "unknown"
             self.producer = "unknown"
             self.subject = "unknown"
             self.title = "unknown"
             self.table_of_contents = []
 
+    __slots__ = ("is_pdf", "info", "path", "ocr_path", "num_pages", "images", "tables", "paragraphs",
+                 "paragraph_pages", "paragraph_coordinates", "extractable", "ocr_pages", "ocr_language", "filename")
+
     def __init__(self, path: str, is_pdf: bool):
         self.is_pdf = is_pdf
         self.info = Document.Info()
@@ -17,9 +74,65 @@ class Document:
         self.images = []
         self.tables = []
         self.paragraphs = []
+        # page number of every paragraph
+        self.paragraph_pages = array('i')
+        # x0, y0, x1, y1 of every paragraph in PDF points with origin in the bottom left corner of the page, NaN if
+        # bounding box is not known. Columns are kept in arrays, which are much smaller than lists of tuples
+        self.paragraph_coordinates = array('d')
         self.extractable = False
+        # numbers of pages, which still have to be OCRed
+        self.ocr_pages = []
+        # Tesseract language used for OCR
+        self.ocr_language = None
         self.filename = None
 
+    # Compact binary state used by pickle, so documents are cheap to send between processes, cache and journal.
+    # Paragraphs are stored as a single string and their lengths
+    def __getstate__(self):
+        info = tuple(getattr(self.info, name) for name in Document.Info.__slots__)
+        return (self.path, self.is_pdf, self.ocr_path, self.filename, self.num_pages, self.extractable,
+                self.ocr_pages, self.ocr_language, info, "".join(self.paragraphs),
+                array('I', (len(paragraph) for paragraph in self.paragraphs)), self.paragraph_pages,
+                self.paragraph_coordinates, self.tables, self.images)
+
+    def __setstate__(self, state):
+        (self.path, self.is_pdf, self.ocr_path, self.filename, self.num_pages, self.extractable, self.ocr_pages,
+         self.ocr_language, info, text, lengths, self.paragraph_pages, self.paragraph_coordinates, self.tables,
+         self.images) = state
+        self.info = Document.Info()
+        for name, value in zip(Document.Info.__slots__, info):
+            setattr(self.info, name, value)
+        self.paragraphs = []
+        start = 0
+        for length in lengths:
+            self.paragraphs.append(text[start:start + length])
+            start += length
+
+    def add_paragraph(self, text: str, page: int, bbox=None):
+        self.paragraphs.append(text)
+        self.paragraph_pages.append(page)
+        self.paragraph_coordinates.extend(bbox if bbox is not None else (math.nan,) * 4)
+
+    # Returns bounding box of the paragraph or None if it is not known
+    def paragraph_bbox(self, i: int):
+        bbox = tuple(self.paragraph_coordinates[4 * i:4 * i + 4])
+        return None if math.isnan(bbox[0]) else bbox
+
+    # Replaces camelot tables with plain tables, so the document is small when it is sent between processes or
+    # cached
+    def compact(self):
+        self.tables = [table if isinstance(table, Table) else Table.from_camelot(table) for table in self.tables]
+        return self
+
+    # Order paragraphs by page, keeping order of paragraphs on the same page.
+    # Used after text of OCRed pages is added to text extracted from other pages
+    def sort_paragraphs_by_page(self):
+        order = sorted(range(len(self.paragraphs)), key=lambda i: self.paragraph_pages[i])
+        self.paragraphs = [self.paragraphs[i] for i in order]
+        self.paragraph_pages = array('i', (self.paragraph_pages[i] for i in order))
+        self.paragraph_coordinates = array('d', (coordinate for i in order
+                                                 for coordinate in self.paragraph_coordinates[4 * i:4 * i + 4]))
+
     def document_info_to_string(self):
         return "Author: " + self.info.author + "\n" \
                + "Producer: " + self.info.producer + "\n" \
@@ -32,3 +145,21 @@ class Document:
         for tup in self.info.table_of_contents:
             output_string += str(tup[0]) + ': ' + tup[1] + '\n'
         return output_string
+
+
+class SearchResult:
+    # paragraphs and tables of a document, which contain search words, their positions in the document and their
+    # match scores. document is the searched document, when its content is exported with the results
+    __slots__ = ("path", "paragraphs", "tables", "paragraph_positions", "paragraph_scores", "table_positions",
+                 "table_scores", "document")
+
+    def __init__(self, path: str, paragraphs, tables, paragraph_positions=(), paragraph_scores=(), table_positions=(),
+                 table_scores=(), document=None):
+        self.path = path
+        self.paragraphs = paragraphs
+        self.tables = tables
+        self.paragraph_positions = paragraph_positions
+        self.paragraph_scores = paragraph_scores
+        self.table_positions = table_positions
+        self.table_scores = table_scores
+        self.document = document
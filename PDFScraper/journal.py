@@ -0,0 +1,95 @@
+import logging
+import os
+import pickle
+
+logger = logging.getLogger("PDFScraper")
+
+
+# Identifies the version of the file, documents which changed since they were journaled are processed again
+def file_state(path: str):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+# Append-only journal of documents finished in a batch run, so an interrupted run can be resumed.
+# The first record stores settings of the run, every other record stores path and state of a finished document
+# and its result. Records are flushed to disk one by one, a record cut short by a crash is discarded on resume.
+class Journal:
+    def __init__(self, path: str, settings: dict, resume=False):
+        self.path = path
+        self.settings = settings
+        # path -> (file state, offset of the record)
+        self.entries = {}
+        end = 0
+        if resume and os.path.isfile(path):
+            end = self._load()
+        self.file = open(path, 'r+b' if end > 0 else 'wb')
+        self.file.truncate(end)
+        self.file.seek(end)
+        if end == 0:
+            self._append(settings)
+
+    def _load(self):
+        end = 0
+        with open(self.path, 'rb') as f:
+            try:
+                if pickle.load(f) != self.settings:
+                    logger.warning("Journal " + self.path + " was written with different settings, starting over")
+                    return 0
+                end = f.tell()
+                while True:
+                    offset = f.tell()
+                    path, state, _ = pickle.load(f)
+                    self.entries[path] = (state, offset)
+                    end = f.tell()
+            except EOFError:
+                pass
+            except Exception as e:
+                logger.warning("Ignoring incomplete record in journal " + self.path + ": " + str(e))
+        return end
+
+    def _append(self, record):
+        pickle.dump(record, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        self.file.close()
+
+    # Removes the journal once the run is finished
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+    # Returns True if document was finished in the journaled run and did not change since
+    def is_done(self, path: str):
+        if path not in self.entries:
+            return False
+        try:
+            return file_state(path) == self.entries[path][0]
+        except OSError:
+            return False
+
+    def add(self, path: str, result):
+        offset = self.file.tell()
+        state = file_state(path)
+        self._append((path, state, result))
+        self.entries[path] = (state, offset)
+
+    # Lazily reads results of finished documents, so they are never all in memory
+    def results(self):
+        with open(self.path, 'rb') as f:
+            for path in sorted(self.entries):
+                if not self.is_done(path):
+                    continue
+                f.seek(self.entries[path][1])
+                yield pickle.load(f)[2]
@@ -0,0 +1,139 @@
+import logging
+import os
+import tempfile
+
+import cv2
+from PIL import Image
+
+# tesserocr is optional, without it every OCR call starts a new tesseract process through pytesseract
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+logger = logging.getLogger("PDFScraper")
+
+# Tesseract engines of the current process, keyed by tessdata location, language, page segmentation mode, engine
+# mode and variables. Loading of language models takes most of the time of a tesseract run, so engines are reused
+# across pages and documents
+engines = {}
+# errors of engines, which could not be created, keyed like engines. OCR with such an engine falls back to
+# pytesseract in auto mode, other engines are still used
+engine_errors = {}
+
+
+# Converts tesseract command line options to engine settings.
+# Returns None if options can only be handled by the tesseract command line program
+def parse_config(config_options: str):
+    tokens = config_options.split()
+    config = {"language": None, "tessdata": None, "psm": None, "oem": None, "variables": ()}
+    variables = []
+    i = 0
+    while i < len(tokens):
+        if i + 1 >= len(tokens):
+            return None
+        option, value = tokens[i], tokens[i + 1]
+        if option == "-l":
+            config["language"] = value
+        elif option == "--tessdata-dir":
+            config["tessdata"] = value
+        elif option == "--dpi":
+            variables.append(("user_defined_dpi", value))
+        elif option in ("--psm", "--oem"):
+            try:
+                config[option[2:]] = int(value)
+            except ValueError:
+                return None
+        elif option == "-c" and "=" in value:
+            variables.append(tuple(value.split("=", 1)))
+        else:
+            return None
+        i += 2
+    config["variables"] = tuple(variables)
+    return config
+
+
+# Returns True if OCR with the given options should use a persistent engine
+def use_engine(backend: str, config_options: str):
+    if backend == "pytesseract":
+        return False
+    if tesserocr is None:
+        if backend == "tesserocr":
+            raise RuntimeError("tesserocr is not installed")
+        return False
+    return parse_config(config_options) is not None
+
+
+def get_engine(language: str, config: dict):
+    psm = config["psm"] if config["psm"] is not None else tesserocr.PSM.AUTO
+    oem = config["oem"] if config["oem"] is not None else tesserocr.OEM.DEFAULT
+    key = (config["tessdata"], language, psm, oem, config["variables"])
+    # engine is not loaded again after it failed
+    if key in engine_errors:
+        raise RuntimeError(engine_errors[key])
+    if key not in engines:
+        kwargs = {"lang": language, "psm": psm, "oem": oem}
+        if config["tessdata"] is not None:
+            kwargs["path"] = os.path.join(config["tessdata"], "")
+        try:
+            engine = tesserocr.PyTessBaseAPI(**kwargs)
+        except RuntimeError as e:
+            engine_errors[key] = "Could not load Tesseract engine for " + language + ": " + str(e)
+            logger.warning(engine_errors[key])
+            raise
+        for name, value in config["variables"]:
+            engine.SetVariable(name, value)
+        engines[key] = engine
+    return engines[key]
+
+
+def close_engines():
+    for engine in engines.values():
+        engine.End()
+    engines.clear()
+
+
+# Converts OpenCV image to PIL image used by tesserocr
+def to_pil(img):
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return Image.fromarray(img)
+
+
+def image_to_string(img, config_options: str):
+    config = parse_config(config_options)
+    engine = get_engine(config["language"] or "eng", config)
+    engine.SetImage(to_pil(img))
+    return engine.GetUTF8Text()
+
+
+# Returns searchable single page PDF with the image and recognised text, same as tesseract's pdf output, and
+# Tesseract TSV of the same recognition pass
+def image_to_pdf_and_data(img, language: str, config_options: str):
+    config = parse_config(config_options)
+    engine = get_engine(config["language"] or language, config)
+    # engine is shared with plain OCR calls, which must not write PDFs
+    create_pdf = engine.GetVariableAsString("tessedit_create_pdf")
+    engine.SetVariable("tessedit_create_pdf", "true")
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            # ProcessPages writes a complete document, PDF renderer embeds the image from the input file
+            image_path = os.path.join(directory, "page.png")
+            cv2.imwrite(image_path, img)
+            output_base = os.path.join(directory, "page")
+            if not engine.ProcessPages(output_base, image_path):
+                raise RuntimeError("Tesseract could not process the page")
+            with open(output_base + ".pdf", 'rb') as f:
+                pdf = f.read()
+        # results of the processed page are kept by the engine
+        return pdf, engine.GetTSVText(0)
+    finally:
+        engine.SetVariable("tessedit_create_pdf", create_pdf)
+
+
+# Returns Tesseract TSV with boxes of blocks, paragraphs, lines and words
+def image_to_data(img, language: str, config_options: str):
+    config = parse_config(config_options)
+    engine = get_engine(config["language"] or language, config)
+    engine.SetImage(to_pil(img))
+    return engine.GetTSVText(0)
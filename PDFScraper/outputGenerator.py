@@ -1,26 +1,23 @@
-import codecs
+import html
+import json
 import os
-import re
-import tempfile
 from pathlib import Path
 
 from yattag import Doc, indent
 
-from PDFScraper.core import find_words_paragraphs, find_words_tables
+# pyarrow is optional, it is only needed for the parquet format
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
+from PDFScraper.core import search_document
+from PDFScraper.dataStructure import SearchResult, Table
 
-def generate_html(output_path: str, docs, search_word: str, search_mode: bool):
-    # TODO: implement html generation
-    doc, tag, text = Doc().tagtext()
-
-    doc.asis('<!DOCTYPE html>')
 
-    with tag('html'):
-        with tag('head'):
-
-            # Add css for better looking tables
-            with tag('style'):
-                doc.asis('''
+# css for better looking tables
+STYLE = '''
 
 // Breakpoints
 $bp-maggie: 15em; 
@@ -252,50 +249,267 @@ a {
     } 
   }
 }
-''')
-
-        with tag('body'):
-            with tag('h1', id="heading"):
-                text('Summary of search results')
-            doc_index = 0
-            for document in docs:
-
-                with tag('div', id=str(doc_index)):
-                    doc_index += 1
-                    header_printed = False
-                    # output paragraphs containing search words
-                    for paragraph in find_words_paragraphs(document.paragraphs, search_mode, search_word.split(","),
-                                                           80):
-                        with tag('p'):
-                            if not header_printed:
-                                with tag('h2'):
-                                    text("Found in document with location: " + str(document.path))
-                            header_printed = True
-                            text(paragraph)
-                    # output tables containing search words
-                    table_index = 0
-                    for table in find_words_tables(document.tables, search_mode, search_word.split(","), 80):
-                        with tag('div', id="table" + str(table_index), klass="container"):
-                            table_index += 1
-                            tempfile_path = tempfile.gettempdir() + "/PDFScraper"
-                            try:
-                                os.makedirs(tempfile_path)
-                            except FileExistsError:
-                                pass
-                            tempfile_path = tempfile_path + "/table"
-                            table.to_html(tempfile_path, classes="responsive-table", index=False)
-                            with codecs.open(tempfile_path, 'r') as table_file:
-                                # replace \n in table to fix formatting
-                                tab = re.sub(r'\\n', '<br>', table_file.read())
-                                if not header_printed:
-                                    with tag('h2'):
-                                        text("Found in document with location: " + str(document.path))
-                                doc.asis(tab)
-                            os.remove(tempfile_path)
-
-    # write HTML to file
+'''
+
+
+# Returns directory in which results are written, output path can also be a file in that directory
+def output_directory(output_path: str):
     # check if output path is a directory
     if not os.path.isdir(output_path):
         output_path = str(Path(output_path).parent)
-    with open(output_path + "/summary.html", "w", encoding='utf-8') as file:
-        file.write(indent(doc.getvalue()))
+    return output_path
+
+
+# Renders table cells as HTML table, same as pandas' to_html without index. Line breaks in cells are kept
+def table_html(cells):
+    columns = max((len(row) for row in cells), default=0)
+    doc, tag, text = Doc().tagtext()
+    with tag('table', border="1", klass="dataframe responsive-table"):
+        with tag('thead'):
+            with tag('tr', style="text-align: right;"):
+                for column in range(columns):
+                    with tag('th'):
+                        text(str(column))
+        with tag('tbody'):
+            for row in cells:
+                with tag('tr'):
+                    for cell in row:
+                        with tag('td'):
+                            doc.asis(html.escape(str(cell)).replace("\n", "<br>"))
+    return doc.getvalue()
+
+
+# Writes summary of search results to summary.html one document at a time, so results appear in the file as soon as
+# documents are searched and results of all documents are never kept in memory.
+# With page_size, summary is split into pages summary.html, summary_2.html, ... and a new page is started once the
+# current page contains page_size paragraphs and tables
+class HtmlWriter:
+    # only search results are written, content of documents is not needed
+    content = False
+
+    def __init__(self, output_path: str, page_size=0):
+        self.output_path = output_directory(output_path)
+        self.page_size = page_size
+        self.page = 0
+        self.page_hits = 0
+        self.doc_index = 0
+        self.file = None
+        self._open_page()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def page_name(page: int):
+        return "summary.html" if page == 1 else "summary_" + str(page) + ".html"
+
+    def _open_page(self):
+        self.page += 1
+        self.page_hits = 0
+        self.file = open(os.path.join(self.output_path, HtmlWriter.page_name(self.page)), "w", encoding='utf-8')
+        doc, tag, text = Doc().tagtext()
+        with tag('head'):
+            with tag('style'):
+                doc.asis(STYLE)
+        self.file.write('<!DOCTYPE html>\n<html>\n' + indent(doc.getvalue()) + '\n<body>\n')
+        doc, tag, text = Doc().tagtext()
+        with tag('h1', id="heading"):
+            text('Summary of search results')
+        if self.page > 1:
+            with tag('a', href=HtmlWriter.page_name(self.page - 1)):
+                text('Previous page')
+        self._write(doc)
+
+    def _close_page(self, next_page=False):
+        if next_page:
+            doc, tag, text = Doc().tagtext()
+            with tag('a', href=HtmlWriter.page_name(self.page + 1)):
+                text('Next page')
+            self._write(doc)
+        self.file.write('</body>\n</html>\n')
+        self.file.close()
+
+    def close(self):
+        self._close_page()
+
+    def _write(self, doc):
+        self.file.write(indent(doc.getvalue()) + '\n')
+        self.file.flush()
+
+    def write(self, result: SearchResult):
+        if self.page_size > 0 and self.page_hits >= self.page_size:
+            self._close_page(next_page=True)
+            self._open_page()
+        self.page_hits += len(result.paragraphs) + len(result.tables)
+        doc, tag, text = Doc().tagtext()
+        with tag('div', id=str(self.doc_index)):
+            self.doc_index += 1
+            header_printed = False
+            # output paragraphs containing search words
+            for paragraph in result.paragraphs:
+                with tag('p'):
+                    if not header_printed:
+                        with tag('h2'):
+                            text("Found in document with location: " + str(result.path))
+                    header_printed = True
+                    text(paragraph)
+            # output tables containing search words
+            table_index = 0
+            for table in result.tables:
+                with tag('div', id="table" + str(table_index), klass="container"):
+                    table_index += 1
+                    if not header_printed:
+                        with tag('h2'):
+                            text("Found in document with location: " + str(result.path))
+                        header_printed = True
+                    cells = table.cells if isinstance(table, Table) else Table.from_camelot(table).cells
+                    doc.asis(table_html(cells))
+        self._write(doc)
+
+
+# Columns of exported records. Bounding boxes are in PDF points with origin in the bottom left corner of the page
+EXPORT_COLUMNS = {
+    "documents": ("path", "filename", "num_pages", "author", "creator", "producer", "subject", "title"),
+    "paragraphs": ("path", "position", "page", "x0", "y0", "x1", "y1", "text"),
+    "cells": ("path", "table", "page", "row", "column", "x0", "y0", "x1", "y1", "text"),
+    "hits": ("path", "kind", "position", "page", "x0", "y0", "x1", "y1", "score", "text")
+}
+# type of records of every kind in JSON lines
+EXPORT_TYPES = {"documents": "document", "paragraphs": "paragraph", "cells": "cell", "hits": "hit"}
+
+
+def bbox_columns(bbox):
+    return tuple(bbox) if bbox is not None else (None,) * 4
+
+
+# Returns rows of every kind of exported records for the search result as tuples in order of EXPORT_COLUMNS.
+# Hits refer to paragraphs by their position in the document and to tables by their position among tables
+def export_rows(result: SearchResult):
+    document = result.document
+    info = document.info
+    rows = {"documents": [(document.path, document.filename, document.num_pages, str(info.author),
+                           str(info.creator), str(info.producer), str(info.subject), str(info.title))],
+            "paragraphs": [], "cells": [], "hits": []}
+    for position, (text, page) in enumerate(zip(document.paragraphs, document.paragraph_pages)):
+        rows["paragraphs"].append((document.path, position, page) + bbox_columns(document.paragraph_bbox(position))
+                                  + (text,))
+    tables = [table if isinstance(table, Table) else Table.from_camelot(table) for table in document.tables]
+    for position, table in enumerate(tables):
+        for row, cells in enumerate(table.cells):
+            for column, text in enumerate(cells):
+                rows["cells"].append((document.path, position, int(table.page), row, column)
+                                     + bbox_columns(table.bbox) + (str(text),))
+    for position, score in zip(result.paragraph_positions, result.paragraph_scores):
+        rows["hits"].append((document.path, "paragraph", position, document.paragraph_pages[position])
+                            + bbox_columns(document.paragraph_bbox(position))
+                            + (score, document.paragraphs[position]))
+    for position, score in zip(result.table_positions, result.table_scores):
+        table = tables[position]
+        rows["hits"].append((document.path, "table", position, int(table.page)) + bbox_columns(table.bbox)
+                            + (score, None))
+    return rows
+
+
+# Writes content of searched documents and search hits to results.jsonl, one JSON object per line.
+# Every object has a type, which is document, paragraph, cell or hit, and the columns of its kind in EXPORT_COLUMNS
+class JsonlWriter:
+    content = True
+
+    def __init__(self, output_path: str):
+        self.file = open(os.path.join(output_directory(output_path), "results.jsonl"), "w", encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def write(self, result: SearchResult):
+        for kind, rows in export_rows(result).items():
+            for row in rows:
+                record = {"type": EXPORT_TYPES[kind]}
+                record.update(zip(EXPORT_COLUMNS[kind], row))
+                self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+
+# Writes content of searched documents and search hits to documents.parquet, paragraphs.parquet, cells.parquet and
+# hits.parquet. Rows are buffered and written as row groups of batch_size rows, so memory usage stays bounded
+class ParquetWriter:
+    content = True
+
+    def __init__(self, output_path: str, batch_size=100000):
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for the parquet format, install it with pip install "
+                              "PDFScraper[parquet]")
+        directory = output_directory(output_path)
+        self.batch_size = batch_size
+        self.rows = {kind: [] for kind in EXPORT_COLUMNS}
+        self.writers = {kind: pyarrow.parquet.ParquetWriter(os.path.join(directory, kind + ".parquet"), schema)
+                        for kind, schema in parquet_schemas().items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _flush(self, kind: str):
+        columns = zip(*self.rows[kind])
+        writer = self.writers[kind]
+        writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for column, field in
+                                                      zip(columns, writer.schema)], schema=writer.schema))
+        self.rows[kind] = []
+
+    def close(self):
+        for kind, writer in self.writers.items():
+            if len(self.rows[kind]) > 0:
+                self._flush(kind)
+            writer.close()
+
+    def write(self, result: SearchResult):
+        for kind, rows in export_rows(result).items():
+            self.rows[kind].extend(rows)
+            if len(self.rows[kind]) >= self.batch_size:
+                self._flush(kind)
+
+
+# Types of exported columns
+def parquet_schemas():
+    types = {"path": pyarrow.string(), "filename": pyarrow.string(), "num_pages": pyarrow.int32(),
+             "position": pyarrow.int32(), "page": pyarrow.int32(), "table": pyarrow.int32(), "row": pyarrow.int32(),
+             "column": pyarrow.int32(), "kind": pyarrow.string(), "score": pyarrow.int16(), "text": pyarrow.string()}
+    for name in ("author", "creator", "producer", "subject", "title"):
+        types[name] = pyarrow.string()
+    for name in ("x0", "y0", "x1", "y1"):
+        types[name] = pyarrow.float64()
+    return {kind: pyarrow.schema([(name, types[name]) for name in columns]) for kind, columns in EXPORT_COLUMNS.items()}
+
+
+# Opens writer of search results in the format, which is html, jsonl or parquet
+def open_report(output_path: str, report_format="html", page_size=0):
+    if report_format == "jsonl":
+        return JsonlWriter(output_path)
+    if report_format == "parquet":
+        return ParquetWriter(output_path)
+    return HtmlWriter(output_path, page_size)
+
+
+def generate_report(output_path: str, docs, search_word: str, search_mode: bool, workers=-1, page_size=0,
+                    report_format="html"):
+    with open_report(output_path, report_format, page_size) as writer:
+        for document in docs:
+            result = search_document(document, search_word.split(","), search_mode, 80, workers)
+            if writer.content:
+                result.document = document
+            writer.write(result)
+
+
+def generate_html(output_path: str, docs, search_word: str, search_mode: bool, workers=-1, page_size=0):
+    generate_report(output_path, docs, search_word, search_mode, workers, page_size)
@@ -0,0 +1,97 @@
+import logging
+import multiprocessing
+import signal
+from contextlib import contextmanager
+
+import psutil
+
+logger = logging.getLogger("PDFScraper")
+
+# Stages of the extraction pipeline, which are limited separately
+STAGES = ("parse", "tables", "render", "ocr", "output")
+
+# Approximate memory used by a single task of the stage in bytes. Camelot renders pages for line detection,
+# rendering keeps a 300 DPI page and its preprocessed copies in memory and Tesseract keeps its own copy of the page
+STAGE_MEMORY = {
+    "tables": 300 * 1024 * 1024,
+    "render": 250 * 1024 * 1024,
+    "ocr": 200 * 1024 * 1024
+}
+
+
+# Returns number of tasks of every stage, which can run at once.
+# Stages that are not limited by memory get a task per core, the others also fit into currently available memory
+def auto_limits():
+    cores = multiprocessing.cpu_count()
+    available = psutil.virtual_memory().available
+    limits = {}
+    for stage in STAGES:
+        limits[stage] = cores
+        if stage in STAGE_MEMORY:
+            limits[stage] = max(1, min(cores, available // STAGE_MEMORY[stage]))
+    return limits
+
+
+# Limits concurrency of pipeline stages across all worker processes.
+# Workers receive the scheduler when the pool is created, so its semaphores are shared by all of them.
+# limits maps stage to the number of concurrent tasks, "auto" or missing values are derived with auto_limits
+class Scheduler:
+    def __init__(self, limits=None):
+        limits = dict(limits or {})
+        auto = auto_limits()
+        self.limits = {}
+        for stage in STAGES:
+            limit = limits.get(stage, "auto")
+            self.limits[stage] = auto[stage] if limit in (None, "auto") else max(1, int(limit))
+        self.semaphores = {stage: multiprocessing.BoundedSemaphore(limit) for stage, limit in self.limits.items()}
+        # set when the run is interrupted, workers skip tasks which have not started yet
+        self.stop_event = multiprocessing.Event()
+
+    def __str__(self):
+        return ', '.join(stage + ' ' + str(limit) for stage, limit in self.limits.items())
+
+    def stop(self):
+        self.stop_event.set()
+
+    @property
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    # Blocks until a task of the stage can run
+    @contextmanager
+    def stage(self, name: str):
+        with self.semaphores[name]:
+            yield
+
+    # Creates pool of workers for the stage, the number of workers is the limit of the stage
+    def pool(self, name: str, initializer=None, initargs=()):
+        return multiprocessing.Pool(self.limits[name], initializer=init_worker,
+                                    initargs=(self, initializer, initargs))
+
+
+# Scheduler of the current worker process
+worker_scheduler = None
+
+
+def init_worker(scheduler: Scheduler, initializer, initargs):
+    global worker_scheduler
+    worker_scheduler = scheduler
+    # interrupts are handled by the parent process, which lets workers finish their current tasks
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+# Runs the block as a task of the stage. Outside of scheduler pools, tasks are not limited
+@contextmanager
+def stage(name: str):
+    if worker_scheduler is None:
+        yield
+    else:
+        with worker_scheduler.stage(name):
+            yield
+
+
+# Returns True if the run was interrupted and the worker should skip its task
+def stopped():
+    return worker_scheduler is not None and worker_scheduler.stopped
@@ -0,0 +1,173 @@
+import json
+import logging
+import sqlite3
+
+from PDFScraper.dataStructure import Document, Table
+
+logger = logging.getLogger("PDFScraper")
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    filename TEXT,
+    is_pdf INTEGER NOT NULL,
+    num_pages INTEGER,
+    author TEXT,
+    creator TEXT,
+    producer TEXT,
+    subject TEXT,
+    title TEXT,
+    table_of_contents TEXT
+);
+CREATE TABLE IF NOT EXISTS paragraphs (
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    page INTEGER,
+    text TEXT NOT NULL,
+    bbox TEXT
+);
+CREATE TABLE IF NOT EXISTS tables (
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    page INTEGER,
+    bbox TEXT,
+    cells TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY REFERENCES documents(path) ON DELETE CASCADE,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS failed_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS paragraphs_document ON paragraphs(document_id, position);
+CREATE INDEX IF NOT EXISTS tables_document ON tables(document_id, position);
+'''
+
+
+def bbox_json(bbox):
+    return None if bbox is None else json.dumps(bbox)
+
+
+# Persistent index of extracted paragraphs and tables, stored in a SQLite database.
+# Documents are extracted once with the index command and can then be searched many times with the query command.
+class SearchIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+        paragraph_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(paragraphs)")]
+        # indexes created before pages of paragraphs were stored, their paragraphs get unknown page 0
+        if "page" not in paragraph_columns:
+            self.connection.execute("ALTER TABLE paragraphs ADD COLUMN page INTEGER NOT NULL DEFAULT 0")
+        # indexes created before bounding boxes of paragraphs were stored
+        if "bbox" not in paragraph_columns:
+            self.connection.execute("ALTER TABLE paragraphs ADD COLUMN bbox TEXT")
+        # indexes created before creators of documents were stored
+        if "creator" not in [row[1] for row in self.connection.execute("PRAGMA table_info(documents)")]:
+            self.connection.execute("ALTER TABLE documents ADD COLUMN creator TEXT")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    # Stores document in the index, replacing previously indexed version of the same path
+    def add_document(self, document: Document):
+        with self.connection:
+            self.connection.execute("DELETE FROM documents WHERE path = ?", (document.path,))
+            self.connection.execute("DELETE FROM failed_files WHERE path = ?", (document.path,))
+            cursor = self.connection.execute(
+                "INSERT INTO documents (path, filename, is_pdf, num_pages, author, creator, producer, subject, "
+                "title, table_of_contents) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (document.path, document.filename, int(document.is_pdf), document.num_pages, str(document.info.author),
+                 str(document.info.creator), str(document.info.producer), str(document.info.subject),
+                 str(document.info.title),
+                 json.dumps([[level, str(title)] for level, title in document.info.table_of_contents])))
+            document_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO paragraphs (document_id, position, page, text, bbox) VALUES (?, ?, ?, ?, ?)",
+                ((document_id, position, page, paragraph, bbox_json(document.paragraph_bbox(position)))
+                 for position, (paragraph, page) in enumerate(zip(document.paragraphs, document.paragraph_pages))))
+            tables = [table if isinstance(table, Table) else Table.from_camelot(table) for table in document.tables]
+            self.connection.executemany(
+                "INSERT INTO tables (document_id, position, page, bbox, cells) VALUES (?, ?, ?, ?, ?)",
+                ((document_id, position, table.page, json.dumps(table.bbox), json.dumps(table.cells))
+                 for position, table in enumerate(tables)))
+
+    # Manifest of indexed files, used by incremental indexing to find new and changed files.
+    # Entry is removed together with its document
+    def set_file(self, path: str, size: int, mtime: int, sha256: str):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO files (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+                                    (path, size, mtime, sha256))
+
+    # Returns dictionary of path -> (size, mtime, sha256) of indexed files
+    def files(self):
+        return {path: (size, mtime, sha256) for path, size, mtime, sha256 in
+                self.connection.execute("SELECT path, size, mtime, sha256 FROM files")}
+
+    # Files which could not be extracted are recorded with their size and modification time, so incremental indexing
+    # only tries them again once they change
+    def set_failed(self, path: str, size: int, mtime: int):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO failed_files (path, size, mtime) VALUES (?, ?, ?)",
+                                    (path, size, mtime))
+
+    # Returns dictionary of path -> (size, mtime) of files, which could not be extracted
+    def failed_files(self):
+        return {path: (size, mtime) for path, size, mtime in
+                self.connection.execute("SELECT path, size, mtime FROM failed_files")}
+
+    def remove_failed(self, path: str):
+        with self.connection:
+            self.connection.execute("DELETE FROM failed_files WHERE path = ?", (path,))
+
+    # Returns paths of all indexed documents
+    def paths(self):
+        return [path for (path,) in self.connection.execute("SELECT path FROM documents")]
+
+    def remove_document(self, path: str):
+        with self.connection:
+            self.connection.execute("DELETE FROM documents WHERE path = ?", (path,))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    # Lazily loads indexed documents one by one, so the whole index is never held in memory
+    def documents(self):
+        rows = self.connection.execute(
+            "SELECT id, path, filename, is_pdf, num_pages, author, creator, producer, subject, title, "
+            "table_of_contents FROM documents ORDER BY path")
+        for (document_id, path, filename, is_pdf, num_pages, author, creator, producer, subject, title,
+             table_of_contents) in rows.fetchall():
+            document = Document(path, bool(is_pdf))
+            document.filename = filename
+            document.num_pages = num_pages
+            document.extractable = True
+            document.info.author = author
+            # creator is not stored for documents indexed by older versions
+            document.info.creator = creator if creator is not None else "unknown"
+            document.info.producer = producer
+            document.info.subject = subject
+            document.info.title = title
+            document.info.table_of_contents = [tuple(entry) for entry in json.loads(table_of_contents)]
+            for page, text, bbox in self.connection.execute(
+                    "SELECT page, text, bbox FROM paragraphs WHERE document_id = ? ORDER BY position", (document_id,)):
+                document.add_paragraph(text, page, None if bbox is None else json.loads(bbox))
+            document.tables = [Table(page, json.loads(bbox), json.loads(cells)) for (page, bbox, cells) in
+                               self.connection.execute(
+                                   "SELECT page, bbox, cells FROM tables WHERE document_id = ? ORDER BY position",
+                                   (document_id,))]
+            yield document
@@ -0,0 +1,57 @@
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
+from pdfminer.utils import decode_text
+
+
+# Opens and parses PDF file once. Metadata, table of contents and page layouts are all read from the same parsed
+# document and the file is closed when the session is closed, either explicitly or at the end of the with block
+class DocumentSession:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            parser = PDFParser(self.file)
+            self.pdf_object = PDFDocument(parser)
+            parser.set_document(self.pdf_object)
+        except Exception:
+            self.file.close()
+            raise
+        self._num_pages = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def extractable(self):
+        return self.pdf_object.is_extractable
+
+    @property
+    def num_pages(self):
+        if self._num_pages is None:
+            try:
+                # page tree root knows the number of pages, so pages do not have to be parsed
+                self._num_pages = int(resolve1(resolve1(self.pdf_object.catalog['Pages'])['Count']))
+            except (KeyError, TypeError, ValueError):
+                self._num_pages = sum(1 for _ in PDFPage.create_pages(self.pdf_object))
+        return self._num_pages
+
+    # Returns document information dictionary with decoded string values
+    def metadata(self):
+        metadata = {}
+        for info in self.pdf_object.info:
+            for key, value in info.items():
+                value = resolve1(value)
+                if isinstance(value, bytes):
+                    value = decode_text(value)
+                if isinstance(value, str):
+                    metadata[key] = value
+        return metadata
+
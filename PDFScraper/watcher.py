@@ -0,0 +1,75 @@
+import logging
+import os
+import time
+
+# inotify is optional, without it the watched path is polled
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+logger = logging.getLogger("PDFScraper")
+
+
+# Waits for files under the watched path to change.
+# Uses inotify when inotify_simple is installed and falls back to polling every interval seconds.
+# accept returns True for paths of files, whose changes should be reported, by default all changes are reported
+class Watcher:
+    def __init__(self, path: str, interval=60.0, accept=None):
+        self.path = path
+        self.interval = interval
+        self.accept = accept if accept is not None else lambda file_path: True
+        self.inotify = None
+        # watch descriptor -> watched directory
+        self.directories = {}
+        if INotify is None:
+            logger.info("inotify_simple is not installed, polling " + path + " every " + str(interval) + " seconds")
+            return
+        try:
+            self.inotify = INotify()
+            self.mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE
+            self._watch_tree(path if os.path.isdir(path) else os.path.dirname(path))
+        except OSError as e:
+            logger.warning("Could not watch " + path + " with inotify, polling instead: " + str(e))
+            self.inotify = None
+
+    def _watch_tree(self, path: str):
+        for root, _, _ in os.walk(path):
+            try:
+                self.directories[self.inotify.add_watch(root, self.mask)] = root
+            except OSError as e:
+                logger.warning("Could not watch " + root + ": " + str(e))
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+    # Blocks until files change, including changes made since the last call, or until stop returns True.
+    # Returns True if files changed
+    def wait(self, stop=lambda: False):
+        if self.inotify is None:
+            deadline = time.monotonic() + self.interval
+            while time.monotonic() < deadline:
+                if stop():
+                    return False
+                time.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+            return True
+        changed = False
+        while not stop():
+            events = self.inotify.read(timeout=1000)
+            for event in events:
+                event_path = os.path.join(self.directories.get(event.wd, self.path), event.name)
+                if event.mask & flags.ISDIR:
+                    # new directories have to be watched as well
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        self._watch_tree(event_path)
+                    # moved directories can contain files, empty directories are only created
+                    if event.mask & (flags.MOVED_TO | flags.MOVED_FROM):
+                        changed = True
+                # files written by the program itself, like the index, are not accepted
+                elif self.accept(event_path):
+                    changed = True
+            # return once files stop changing, so files which are still being copied are not processed
+            if changed and len(events) == 0:
+                return True
+        return False